@@ -0,0 +1,43 @@
+"""
+    Columnar caches for expensive raw data ingestion. The files are stored in
+    the working directory of the stage that reads them and are keyed by a
+    fingerprint of the source file and of the configuration that determines
+    their content.
+"""
+
+import os
+import hashlib
+import pandas as pd
+
+def get_path(context, name, key):
+    return "%s/%s_%s.parquet" % (context.path(), name, key)
+
+def get_file_key(path):
+    return "%d_%d" % (os.path.getsize(path), int(os.path.getmtime(path)))
+
+def get_key(*values):
+    # Combines the source file fingerprint and the relevant configuration
+    return hashlib.md5(repr(values).encode("utf-8")).hexdigest()
+
+def get_checksum(path, chunk_size = 2**20):
+    checksum = hashlib.md5()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+def read(context, name, key):
+    path = get_path(context, name, key)
+
+    if os.path.exists(path):
+        print("Reading cached %s from %s" % (name, path))
+        return pd.read_parquet(path)
+
+    return None
+
+def write(context, name, key, df):
+    path = get_path(context, name, key)
+    df.to_parquet(path)
+    print("Cached %s in %s" % (name, path))
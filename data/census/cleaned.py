@@ -3,10 +3,12 @@ import pandas as pd
 import numpy as np
 import geopandas as gpd
 import pyreadstat
+import data.spatial.utils
 
 def configure(context):
     context.stage("data.census.raw")
     context.stage("data.spatial.zones")
+    context.stage("data.spatial.areas")
 
 def execute(context):
     # Import census from previous stage
@@ -26,24 +28,13 @@ def execute(context):
         np.sum(f), len(df), 100.0 * np.sum(f) / len(df)
     ))
     df = df[~f]
-    zone_id = df["zone_id"].values.tolist() 
 
-    # Import shapefiles defining the different zones
-    center = gpd.read_file("%s/Spatial/SC2010_RMSP_CEM_V3_center.shp" % context.config("data_path"))
-    center["AP_2010_CH"] = center["AP_2010_CH"].astype(np.int)
-    center = center["AP_2010_CH"].values.tolist()
-
-    city = gpd.read_file("%s/Spatial/SC2010_RMSP_CEM_V3_city.shp" % context.config("data_path")) 
-    city["AP_2010_CH"] = city["AP_2010_CH"].astype(np.int)
-    city = city["AP_2010_CH"].values.tolist()
-
-    region = context.stage("data.spatial.zones")
-    region = region["zone_id"].values.tolist()
+    # Zones defining the different areas
+    df_areas = context.stage("data.spatial.areas")[0]
 
     print("Imputing residence area index")
     # New localization variable: 3 in the city center, 2 in the Sao-Paulo city and 1 otherwise
-    sp_area = [3 * (z in center) + 2 * (z in city and z not in center) + 1 * (z in region and z not in city) for z in zone_id]
-    df["residence_area_index"] = sp_area
+    df["residence_area_index"] = data.spatial.utils.get_residence_area_index(df_areas, df["zone_id"].values)
     print("Done")
 
     # Attributes renaming and some cleaning
@@ -64,20 +55,17 @@ def execute(context):
     df["household_size"] = df["numberOfMembers"]
     print("Done")
 
-    # Create household ID
+    # Create household ID: members of a household are stored consecutively
+    # and all carry the household size. Within each run of equal sizes, a
+    # new household starts every numberOfMembers rows.
     print("Create household id")
-    i = 0
-    hhl_number = 1
-    hhl_id = []
-    while i < len(df):
-        nom = df.iloc[i]["numberOfMembers"]
-        nom = int(nom)
-        for j in range(nom):
-            hhl_id.append(hhl_number)
-        hhl_number += 1
-        i += nom
+    members = df["numberOfMembers"].values.astype(np.int)
+
+    run_starts = np.flatnonzero(np.r_[True, members[1:] != members[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(members)])
+    run_offsets = np.arange(len(members)) - np.repeat(run_starts, run_lengths)
 
-    df["household_id"] = hhl_id
+    df["household_id"] = np.cumsum(run_offsets % members == 0)
     print("Done")
     
     # Clean up
@@ -1,39 +1,64 @@
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import geopandas as gpd
 import pyreadstat
 import os
+import data.cache
 
 def configure(context):
     context.config("data_path")    
     context.config("census_file")
-def execute(context):
 
-    columns = ['V0001', 'V0011', 'V0221', 'V0222', 'V0601', 'V6036', 'V0401', 'V1004', 'V0010', 'V0641', 'V0642', 'V0643', 'V0644', 'V0628', 'V6529', 'V0504']
+COLUMNS = ['V0001', 'V0011', 'V0221', 'V0222', 'V0601', 'V6036', 'V0401', 'V1004', 'V0010', 'V0641', 'V0642', 'V0643', 'V0644', 'V0628', 'V6529', 'V0504']
+NAMES = ["federationCode", "areaCode", "householdWeight", "metropolitanRegion", "personNumber", "gender", "age", "goingToSchool", "employment", "onLeave", "helpsInWork", "farmWork", "householdIncome", "motorcycleAvailability", "carAvailability", "numberOfMembers"]
+
+# Small integer codes fit exactly into float32 (which keeps NaN for missing
+# values), the household weights are kept in float64
+CODE_COLUMNS = ["personNumber", "gender", "age", "goingToSchool", "employment", "onLeave", "helpsInWork", "farmWork", "motorcycleAvailability", "carAvailability", "numberOfMembers"]
+
+CHUNK_SIZE = 500000 
 
-    CHUNK_SIZE = 500000 
+# Increase if the content of the cached census subset changes
+CACHE_VERSION = 2
 
+def read_census(path):
     # Read the file in chunks
-    reader = pyreadstat.read_file_in_chunks(pyreadstat.read_sav, "%s/Census/%s" % (context.config("data_path"), context.config("census_file")), chunksize= CHUNK_SIZE, usecols=columns)
-    #reader = pd.read_spss("%s/Census/Censo.2010.brasil.amostra.10porcento.sav" % context.config("data_path"))
-
-    # Get column names and create output dataframe
-    df, meta = pyreadstat.read_sav("%s/Census/%s" % (context.config("data_path"), context.config("census_file")), row_offset=1, row_limit=1,usecols=columns)
-    df_census = pd.DataFrame(columns = df.columns)
-    
-    # Fill in the output dataframe with relevant observations from chunks
-    i = CHUNK_SIZE
-    dfs = []
-    for df, meta in reader:
-    	# Keep only those in Sao Paulo state
-        df1 = df[df["V0001"] == '35']
-        df_census = pd.concat([df_census, df1])
-        print("Processed " + repr(i) + " samples.")
-        i = i + CHUNK_SIZE
-
-    # Renaming
-    df_census.columns = ["federationCode", "areaCode", "householdWeight", "metropolitanRegion", "personNumber", "gender", "age", "goingToSchool", "employment", "onLeave", "helpsInWork", "farmWork", "householdIncome", "motorcycleAvailability", "carAvailability", "numberOfMembers"]
+    reader = pyreadstat.read_file_in_chunks(pyreadstat.read_sav, path, chunksize = CHUNK_SIZE, usecols = COLUMNS)
+
+    # Collect relevant observations from chunks and concatenate them once
+    chunks = []
+
+    for index, (df, meta) in enumerate(reader):
+        # Keep only those in Sao Paulo state
+        df = df[df["V0001"] == '35'].copy()
+        df.columns = NAMES
+
+        for column in CODE_COLUMNS:
+            df[column] = df[column].astype(np.float32)
+
+        df["householdWeight"] = df["householdWeight"].astype(np.float64)
+
+        chunks.append(df)
+        print("Processed " + repr((index + 1) * CHUNK_SIZE) + " samples.")
+
+    df_census = pd.concat(chunks)
+
+    for column in ("federationCode", "areaCode", "metropolitanRegion"):
+        df_census[column] = df_census[column].astype("category")
+
+    return df_census
+
+def execute(context):
+    path = "%s/Census/%s" % (context.config("data_path"), context.config("census_file"))
+
+    # The Sao Paulo subset is cached, so the national file is only scanned
+    # again if it, the selected columns or the reader change
+    cache_key = data.cache.get_key(data.cache.get_file_key(path), path, COLUMNS, NAMES, CODE_COLUMNS, CACHE_VERSION)
+    df_census = data.cache.read(context, "census_sao_paulo", cache_key)
+
+    if df_census is None:
+        df_census = read_census(path)
+        data.cache.write(context, "census_sao_paulo", cache_key, df_census)
 
     # The following step only concerns children
     df_census['employment'] = df_census['employment'].fillna(2.0) 
@@ -63,7 +88,9 @@ def execute(context):
 
 
 def validate(context):
-    if not os.path.exists("%s/Census/Censo.2010.brasil.amostra.10porcento.sav" % context.config("data_path")):
+    path = "%s/Census/%s" % (context.config("data_path"), context.config("census_file"))
+
+    if not os.path.exists(path):
         raise RuntimeError("Census 2010 not available.")
 
-    return os.path.getsize("%s/Census/Censo.2010.brasil.amostra.10porcento.sav" % context.config("data_path"))
+    return os.path.getsize(path)
@@ -3,20 +3,21 @@ import pandas as pd
 import numpy as np
 import geopandas as gpd
 import shapely.geometry as geo
-from simpledbf import Dbf5
 import time
+import data.spatial.utils
+import data.hts.dbf
+import data.cache
 
 def configure(context):
     context.stage("data.spatial.zones")
     context.config("data_path")
     context.config("hts_file")    
+    context.stage("data.spatial.areas")
 
 def execute(context):
-	
-    dbf = Dbf5("%s/HTS/%s" %  (context.config("data_path"), context.config("hts_file") ))
-    df = dbf.to_dataframe()
-	
-    df_reduced = df[["ID_PESS","ZONA","IDADE","SEXO",
+    hts_path = "%s/HTS/%s" % (context.config("data_path"), context.config("hts_file"))
+
+    columns = ["ID_PESS","ZONA","IDADE","SEXO",
                 "FE_PESS","FE_VIA",
                 "CD_ATIVI","VL_REN_I","DIA_SEM",
                 "ZONA_O","CO_O_X","CO_O_Y","MOTIVO_O",
@@ -25,7 +26,18 @@ def execute(context):
                 "H_SAIDA","MIN_SAIDA",
                 "H_CHEG","MIN_CHEG",
                 "DURACAO","QT_AUTO","QT_BICICLE","QT_MOTO","N_VIAG",
-                "RENDA_FA", "PAG_VIAG", "TP_ESAUTO", "VL_EST","TIPVG", "CO_DOM_X", "CO_DOM_Y", "ESTUDA"]]	
+                "RENDA_FA", "PAG_VIAG", "TP_ESAUTO", "VL_EST","TIPVG", "CO_DOM_X", "CO_DOM_Y", "ESTUDA"]
+
+    # Only the used fields are decoded from the DBF, and the result is cached
+    # by the checksum of the survey file
+    cache_key = data.cache.get_checksum(hts_path)
+    df_reduced = data.cache.read(context, "hts", cache_key)
+
+    if df_reduced is None or not set(columns) <= set(df_reduced.columns):
+        df_reduced = data.hts.dbf.read(hts_path, columns)
+        data.cache.write(context, "hts", cache_key, df_reduced)
+
+    df_reduced = df_reduced[columns]
 
     # rename columns
     df_reduced.columns = ["person_id","zone","age","gender",
@@ -59,7 +71,7 @@ def execute(context):
                                                      6 : "no", 7 : "no", 8 : "student"})
     df_persons.loc[(~(df_persons["studying"]== 1)) & (df_persons['employed']=='no'), "employed"] = "student"
     # New purpose to trips done by agents aged 18 or more, not going to school but having a trip with education purpose
-    not_students = df_persons[np.logical_and(df_persons["age"] >= 18, df_persons["studying"] == 1)]["person_id"].values.tolist()
+    not_students = df_persons[np.logical_and(df_persons["age"] >= 18, df_persons["studying"] == 1)]["person_id"].values
     
     
     columnsToClean = ["person_id", "weight_person","origin_zone",
@@ -124,24 +136,12 @@ def execute(context):
     home_zones = gpd.sjoin(df_geo[["person_id","geometry"]], df_zones[["zone_id","geometry"]], op = "within",how="left")
     # we ensure with the sjoin how="left" parameter, that GEOID is in the correct order
     df_persons["home_zone"] = home_zones["zone_id"]
-    
-    zone_id = df_persons["home_zone"].values.tolist()
 
-     # Import shapefiles defining the different zones
-    center = gpd.read_file("%s/Spatial/SC2010_RMSP_CEM_V3_center.shp" % context.config("data_path"))
-    center["AP_2010_CH"] = center["AP_2010_CH"].astype(np.int)
-    center = center["AP_2010_CH"].values.tolist()
-
-    city = gpd.read_file("%s/Spatial/SC2010_RMSP_CEM_V3_city.shp" % context.config("data_path")) 
-    city["AP_2010_CH"] = city["AP_2010_CH"].astype(np.int)
-    city = city["AP_2010_CH"].values.tolist()
-
-    region = context.stage("data.spatial.zones")
-    region = region["zone_id"].values.tolist()
+    # Zones defining the different areas
+    df_areas = context.stage("data.spatial.areas")[0]
 
     # New localization variable: 3 in the city center, 2 in the Sao-Paulo city and 1 otherwise
-    sp_area = [3 * (z in center) + 2 * (z in city and z not in center) + 1 * (z in region and z not in city) for z in zone_id]
-    df_persons["residence_area_index"] = sp_area
+    df_persons["residence_area_index"] = data.spatial.utils.get_residence_area_index(df_areas, df_persons["home_zone"].values)
 
     
 
@@ -154,7 +154,7 @@ def execute(context):
     # Trips
 
     # New purpose to trips done by agents aged 18 or more, not going to school but having a trip with education purpose
-    mask = np.isin(df_trips["person_id"].values.tolist(), not_students)
+    mask = df_trips["person_id"].isin(not_students).values
     df_trips.loc[np.logical_and(df_trips["destination_purpose"] == "education", mask), "destination_purpose"] = "other"
     df_trips.loc[np.logical_and(df_trips["origin_purpose"] == "education", mask), "origin_purpose"] = "other" 
 
@@ -198,91 +198,46 @@ def execute(context):
 
     # Adjust trip id
     df_trips = df_trips.sort_values(by = ["person_id", "trip_id"])
-    trips_per_person = df_trips.groupby("person_id").size().reset_index(name = "count")["count"].values
-    df_trips["trip_id"] = np.hstack([np.arange(n) for n in trips_per_person])
-
-    # Remove trips that are the first done by an agent not starting from home
-    first_index_list = df_trips.index[np.logical_and(df_trips["trip_id"]==0, df_trips["origin_purpose"]!="home")] 
-    first_index = df_trips.index.isin(first_index_list)
-    to_remove1 = df_trips[first_index]
-    df_trips = df_trips[~first_index]
-
-    # Remove agents concerned 
-    agents_to_be_removed = to_remove1["person_id"].values.tolist()
-    agents_list = [(df_persons["person_id"].iloc[i] not in agents_to_be_removed) for i in range(len(df_persons))]
-    agents_index_list = df_persons.index[agents_list]
-    agents_index = df_persons.index.isin(agents_index_list)
-    removed_agents_id = df_persons[~agents_index].values.tolist()
-    df_persons = df_persons[agents_index]
-
-    # Adjust trips
-    has_to_be_removed = [df_trips["person_id"].iloc[i] in removed_agents_id   for i in range(len(df_trips)) ]
-    df_trips = df_trips[np.logical_not(has_to_be_removed)]
-
-    # Remove trips that are the last done by an agent not returning to home
-    number_of_trips_per_agent = df_trips.groupby(["person_id"], sort=False)["trip_id"].max()
-    is_last_trip_index = [df_trips["trip_id"].iloc[i] == number_of_trips_per_agent[df_trips["person_id"].iloc[i]]  for i in range(len(df_trips)) ]
-    last_index_list = df_trips.index[np.logical_and(is_last_trip_index, df_trips["destination_purpose"]!="home")] 
-    last_index = df_trips.index.isin(last_index_list)
-    to_remove2 = df_trips[last_index]
-    df_trips = df_trips[~last_index]
-
-    # Remove agents concerned
-    agents_to_be_removed = to_remove2["person_id"].values.tolist()
-    agents_list = [(df_persons["person_id"].iloc[i] not in agents_to_be_removed) for i in range(len(df_persons))]
-    agents_index_list = df_persons.index[agents_list]
-    agents_index = df_persons.index.isin(agents_index_list)
-    removed_agents_id = df_persons[~agents_index].values.tolist()
-    df_persons = df_persons[agents_index]
-
-    # Adjust trips
-    has_to_be_removed = [df_trips["person_id"].iloc[i] in removed_agents_id   for i in range(len(df_trips)) ]
-    df_trips = df_trips[np.logical_not(has_to_be_removed)]
-
-    # Fix inconsistencies
-    pers_id = list(set(df_trips["person_id"].values.tolist() ))
-    to_remove = []
-    for pid in tqdm(pers_id, desc = "Cleaning HTS trips"):
-        df_i = df_trips[df_trips["person_id"] == pid]
-        df_i.sort_values(by=["trip_id"])
-        purposes = []
-        for row in df_i[["person_id", "preceeding_purpose", "following_purpose"]].itertuples(index = False):
-            persid, pp, fp = row
-            purposes.append(pp)
-            purposes.append(fp)
-
-        if len(purposes) == 2:
-            # Only one trip
-            to_remove.append(pid)
-
-        elif purposes[0] != 'home' or purposes[-1] != 'home':
-            # Don't start and end at home
-            to_remove.append(pid)
-
-        else:
-            purposes = purposes[1:-1]
-            i=0
-            while i < len(purposes):
-                p1 = purposes[i]
-                p2 = purposes[i+1]
-                if p1 != p2:
-                    # The agent moved from one activity to another one without reporting the trip
-                    to_remove.append(pid)
-                    break
-                i += 2 
-
-    pid = list(set(to_remove))
-
-    agents_list = [(df_persons["person_id"].iloc[i] not in pid) for i in range(len(df_persons))]
-    agents_index_list = df_persons.index[agents_list]
-    agents_index = df_persons.index.isin(agents_index_list)
-    removed_agents_id = df_persons[~agents_index].values.tolist()
-    df_persons = df_persons[agents_index]
-
-    # Adjust trips
-    has_to_be_removed = [df_trips["person_id"].iloc[i] in removed_agents_id   for i in range(len(df_trips)) ]
-    df_trips = df_trips[np.logical_not(has_to_be_removed)]
-             
+    df_trips["trip_id"] = df_trips.groupby("person_id").cumcount()
+
+    # Remove agents whose first trip does not start from home
+    f = (df_trips["trip_id"] == 0) & (df_trips["origin_purpose"] != "home")
+    removed_person_ids = df_trips.loc[f, "person_id"].unique()
+
+    df_persons = df_persons[~df_persons["person_id"].isin(removed_person_ids)]
+    df_trips = df_trips[~df_trips["person_id"].isin(removed_person_ids)]
+
+    # Remove agents whose last trip does not return to home
+    is_last_trip = df_trips["trip_id"] == df_trips.groupby("person_id")["trip_id"].transform("max")
+    f = is_last_trip & (df_trips["destination_purpose"] != "home")
+    removed_person_ids = df_trips.loc[f, "person_id"].unique()
+
+    df_persons = df_persons[~df_persons["person_id"].isin(removed_person_ids)]
+    df_trips = df_trips[~df_trips["person_id"].isin(removed_person_ids)]
+
+    # Fix inconsistencies (trips are still sorted by person and trip)
+    print("Cleaning HTS trips")
+    person_ids = df_trips["person_id"].values
+    preceeding_purposes = df_trips["preceeding_purpose"].astype(str).values
+    following_purposes = df_trips["following_purpose"].astype(str).values
+
+    is_first_trip = np.r_[True, person_ids[1:] != person_ids[:-1]]
+    is_last_trip = np.r_[person_ids[1:] != person_ids[:-1], True]
+
+    # Only one trip
+    f = is_first_trip & is_last_trip
+
+    # Don't start and end at home
+    f |= is_first_trip & (preceeding_purposes != "home")
+    f |= is_last_trip & (following_purposes != "home")
+
+    # The agent moved from one activity to another one without reporting the trip
+    f[:-1] |= ~is_last_trip[:-1] & (following_purposes[:-1] != preceeding_purposes[1:])
+
+    removed_person_ids = np.unique(person_ids[f])
+
+    df_persons = df_persons[~df_persons["person_id"].isin(removed_person_ids)]
+    df_trips = df_trips[~df_trips["person_id"].isin(removed_person_ids)]
 
     # Crowfly distance
     df_trips["crowfly_distance"] = np.sqrt(
@@ -291,8 +246,7 @@ def execute(context):
 
     # Adjust trip id
     df_trips = df_trips.sort_values(by = ["person_id", "trip_id"])
-    trips_per_person = df_trips.groupby("person_id").size().reset_index(name = "count")["count"].values
-    df_trips["new_trip_id"] = np.hstack([np.arange(n) for n in trips_per_person])
+    df_trips["new_trip_id"] = df_trips.groupby("person_id").cumcount()
 
     # Impute activity duration
     df_duration = pd.DataFrame(df_trips[[
@@ -0,0 +1,74 @@
+"""
+    Column-projected reader for dBase (DBF) files. Records have a fixed width,
+    so the requested fields are mapped with a NumPy structured dtype and each
+    column is decoded in one vectorised pass.
+"""
+
+import numpy as np
+import pandas as pd
+
+def read_header(path):
+    with open(path, "rb") as f:
+        header = f.read(32)
+
+        record_count = int(np.frombuffer(header[4:8], dtype = "<u4")[0])
+        header_length, record_length = np.frombuffer(header[8:12], dtype = "<u2")
+
+        fields = {}
+        offset = 1 # Every record starts with the deletion flag
+
+        while True:
+            descriptor = f.read(32)
+
+            if len(descriptor) == 0 or descriptor[0] == 0x0D:
+                break
+
+            name = descriptor[:11].split(b"\0")[0].decode("ascii").strip()
+            length, decimals = descriptor[16], descriptor[17]
+
+            fields[name] = dict(type = chr(descriptor[11]), offset = offset, length = length, decimals = decimals)
+            offset += length
+
+    return record_count, int(header_length), int(record_length), fields
+
+def decode(values, field, encoding):
+    values = np.char.strip(values)
+
+    if field["type"] in ("N", "F"):
+        values = pd.to_numeric(pd.Series(np.char.decode(values, "ascii")), errors = "coerce").values
+
+        if field["type"] == "N" and field["decimals"] == 0 and not np.any(np.isnan(values)):
+            values = values.astype(np.int64)
+
+        return values
+
+    if field["type"] == "L":
+        result = np.full((len(values),), None, dtype = np.object)
+        result[np.isin(values, [b"T", b"t", b"Y", b"y"])] = True
+        result[np.isin(values, [b"F", b"f", b"N", b"n"])] = False
+        return result
+
+    return np.char.decode(values, encoding)
+
+def read(path, columns, encoding = "utf-8"):
+    record_count, header_length, record_length, fields = read_header(path)
+
+    for column in columns:
+        if not column in fields:
+            raise RuntimeError("Field %s is not available in %s" % (column, path))
+
+    # Only the requested fields are part of the record type
+    dtype = np.dtype(dict(
+        names = ["deleted"] + list(columns),
+        formats = ["S1"] + ["S%d" % fields[column]["length"] for column in columns],
+        offsets = [0] + [fields[column]["offset"] for column in columns],
+        itemsize = record_length
+    ))
+
+    records = np.memmap(path, dtype = dtype, mode = "r", offset = header_length, shape = (record_count,))
+    f = records["deleted"] != b"*"
+
+    return pd.DataFrame({
+        column: decode(records[column][f], fields[column], encoding)
+        for column in columns
+    }, columns = columns)
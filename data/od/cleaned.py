@@ -1,21 +1,43 @@
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import simpledbf
-import itertools
 import shapely.geometry as geo
 import geopandas as gpd
+import data.od.matrix
 
 def configure(context):
     context.stage("data.spatial.zones")
     context.stage("data.hts.cleaned")
 
+# Number of observed origin zones from which zones without observations
+# borrow their destination distribution
+FALLBACK_NEIGHBORS = 5
+
+def make_matrix(df_od, df_zones):
+    zone_ids = np.unique(df_zones["zone_id"]).astype(np.int64)
+
+    f = df_od["origin_id"].isin(zone_ids) & df_od["destination_id"].isin(zone_ids)
+    f &= df_od["weight"] > 0.0
+    df_od = df_od[f]
+
+    matrix = data.od.matrix.ODMatrix.from_entries(
+        zone_ids, df_od["origin_id"].values.astype(np.int64),
+        df_od["destination_id"].values.astype(np.int64), df_od["weight"].values
+    )
+
+    # Zones without observations take the destinations of nearby observed zones
+    print("  Imputing %d zones without observations" % np.sum(matrix.get_counts() == 0))
+
+    df_centroids = df_zones.drop_duplicates("zone_id").set_index("zone_id").loc[zone_ids]
+    coordinates = np.vstack([df_centroids.centroid.x.values, df_centroids.centroid.y.values]).T
+
+    return matrix.impute_missing(coordinates, FALLBACK_NEIGHBORS)
+
 def execute(context):
     
     df_zones = context.stage("data.spatial.zones")
     df_persons = context.stage("data.hts.cleaned")[0]
     df_trips = context.stage("data.hts.cleaned")[1].copy()
-    zone_ids = set(np.unique(df_zones["zone_id"]))
     
     # origin GEOID
     df_trips["geometry"] = [geo.Point(*xy) for xy in zip(df_trips["origin_x"], df_trips["origin_y"])]
@@ -52,67 +74,10 @@ def execute(context):
     
     
     
-    # Compute totals
-    df_work_totals = df_work[["origin_id", "weight"]].groupby("origin_id").sum().reset_index()
-    df_work_totals["total"] = df_work_totals["weight"]
-    del df_work_totals["weight"]
-
-    df_education_totals = df_education[["origin_id", "weight"]].groupby("origin_id").sum().reset_index()
-    df_education_totals["total"] = df_education_totals["weight"]
-    del df_education_totals["weight"]
-   
-
-    # Impute totals
-    #df_work = pd.merge(df_work, df_work_totals, on = ["origin_id", "commute_mode"])
-    df_work = pd.merge(df_work, df_work_totals, on = "origin_id")
-    df_education = pd.merge(df_education, df_education_totals, on = "origin_id")
-
-    # Compute probabilities
-    df_work["weight"] /= df_work["total"]
-    df_education["weight"] /= df_education["total"]
-
-    assert(sum(df_work_totals["total"] == 0.0) == 0)
-    assert(sum(df_education_totals["total"] == 0.0) == 0)
-
-    # Cleanup
-    df_work = df_work[["origin_id", "destination_id", "weight"]]
-    df_education = df_education[["origin_id", "destination_id", "weight"]]
-
-    # Fix missing zones
-    existing_work_ids = set(np.unique(df_work["origin_id"]))
-    missing_work_ids = zone_ids - existing_work_ids
-    existing_education_ids = set(np.unique(df_education["origin_id"]))
-    missing_education_ids = zone_ids - existing_education_ids
-    
-    # TODO: Here we could take the zones of nearby zones in the future. Right now
-    # we just distribute evenly (after all these zones don't seem to have a big impact
-    # if there is nobody in the data set).
+    # Build sparse matrices with normalised rows and save them such that
+    # they can be memory-mapped by the following stages
+    for prefix, df_od in (("work", df_work), ("education", df_education)):
+        print("Building %s OD matrix ..." % prefix)
+        make_matrix(df_od, df_zones).save(context.path(), prefix)
 
-    work_rows = []
-    for origin_id in missing_work_ids:
-        #for destination_id in existing_work_ids:
-            work_rows.append((origin_id, origin_id, 1.0 / len(existing_work_ids)))
-    df_work = pd.concat([df_work, pd.DataFrame.from_records(work_rows, columns = ["origin_id", "destination_id", "weight"])])
-
-    education_rows = []
-    for origin_id in missing_education_ids:
-        #for destination_id in existing_education_ids:
-        education_rows.append((origin_id, origin_id, 1.0 / len(existing_education_ids)))
-    df_education = pd.concat([df_education, pd.DataFrame.from_records(education_rows, columns = ["origin_id", "destination_id", "weight"])])
-
-   
-    df_total = df_work[["origin_id", "weight"]].groupby("origin_id").sum().rename({"weight" : "total"}, axis = 1)
-    df_work = pd.merge(df_work, df_total, on = "origin_id")
-    df_work["weight"] /= df_work["total"]
-    del df_work["total"]
-
-    df_total = df_education[["origin_id", "weight"]].groupby("origin_id").sum().rename({"weight" : "total"}, axis = 1)
-    df_education = pd.merge(df_education, df_total, on = "origin_id")
-    df_education["weight"] /= df_education["total"]
-    del df_education["total"]
-    
-    df_work = df_work.astype({'origin_id': 'int64'})
-    df_work = df_work.astype({'destination_id': 'int64'})
-    df_education = df_education.astype({'origin_id': 'int64'})
-    df_education = df_education.astype({'destination_id': 'int64'})    
-    return df_work, df_education
+    return ["work", "education"]
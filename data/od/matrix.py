@@ -0,0 +1,133 @@
+"""
+    Sparse origin-destination matrix over dense zone indices. Rows are stored
+    in CSR layout together with a cumulative distribution per row, and all
+    arrays are saved as .npy files so that they can be memory-mapped.
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+import scipy.spatial as spatial
+
+ARRAYS = ["zone_ids", "indptr", "indices", "weights", "cdf"]
+
+class ODMatrix:
+    def __init__(self, zone_ids, indptr, indices, weights, cdf):
+        self.zone_ids = zone_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.cdf = cdf
+
+    @classmethod
+    def from_entries(cls, zone_ids, origin_ids, destination_ids, weights):
+        zone_ids = np.unique(zone_ids).astype(np.int64)
+
+        origin_indices = cls.get_indices(zone_ids, origin_ids)
+        destination_indices = cls.get_indices(zone_ids, destination_ids)
+
+        if np.any(origin_indices < 0) or np.any(destination_indices < 0):
+            raise RuntimeError("OD entries refer to unknown zones")
+
+        # Duplicate entries are summed up by the conversion to CSR
+        matrix = sparse.coo_matrix(
+            (np.asarray(weights, dtype = np.float64), (origin_indices, destination_indices)),
+            shape = (len(zone_ids), len(zone_ids))
+        ).tocsr()
+
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+
+        indptr = matrix.indptr.astype(np.int64)
+        indices = matrix.indices.astype(np.int32)
+        weights = matrix.data
+
+        # Row-normalised weights and cumulative distribution per row
+        counts = np.diff(indptr)
+        rows = np.repeat(np.arange(len(zone_ids)), counts)
+        weights = weights / np.bincount(rows, weights = weights, minlength = len(zone_ids))[rows]
+
+        cdf = np.cumsum(weights)
+        cdf -= np.concatenate([[0.0], cdf])[indptr[:-1]][rows]
+        cdf[indptr[1:][counts > 0] - 1] = 1.0
+
+        return cls(zone_ids, indptr, indices, weights, cdf)
+
+    @staticmethod
+    def get_indices(zone_ids, values):
+        values = np.asarray(values)
+        indices = np.minimum(np.searchsorted(zone_ids, values), len(zone_ids) - 1)
+        indices[zone_ids[indices] != values] = -1
+        return indices
+
+    def impute_missing(self, coordinates, neighbors):
+        """
+            Fills the rows without destinations by blending the rows of the
+            nearest origins that have destinations, weighted by inverse
+            distance. Coordinates are given per zone in the order of zone_ids.
+        """
+        observed = np.where(self.get_counts() > 0)[0]
+        missing = np.where(self.get_counts() == 0)[0]
+
+        if len(missing) == 0 or len(observed) == 0:
+            return self
+
+        neighbors = min(neighbors, len(observed))
+        tree = spatial.cKDTree(coordinates[observed])
+
+        distances, neighbor_indices = tree.query(coordinates[missing], k = neighbors)
+        distances = distances.reshape((len(missing), neighbors))
+        neighbor_indices = neighbor_indices.reshape((len(missing), neighbors))
+
+        # Inverse distance weights, the small offset avoids dividing by zero
+        # for zones that share their centroid
+        blending = 1.0 / (distances + 1.0)
+        blending /= np.sum(blending, axis = 1)[:, np.newaxis]
+
+        blending = sparse.csr_matrix((
+            blending.reshape(-1), (np.repeat(missing, neighbors), observed[neighbor_indices.reshape(-1)])
+        ), shape = (len(self.zone_ids), len(self.zone_ids)))
+
+        matrix = (self.to_csr() + blending.dot(self.to_csr())).tocoo()
+
+        return ODMatrix.from_entries(self.zone_ids, self.zone_ids[matrix.row], self.zone_ids[matrix.col], matrix.data)
+
+    def get_counts(self):
+        return np.diff(self.indptr)
+
+    def to_csr(self):
+        return sparse.csr_matrix((self.weights, self.indices, self.indptr), shape = (len(self.zone_ids), len(self.zone_ids)))
+
+    def save(self, path, prefix):
+        for name in ARRAYS:
+            np.save("%s/%s_%s.npy" % (path, prefix, name), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, prefix, mmap_mode = "r"):
+        return cls(*[
+            np.load("%s/%s_%s.npy" % (path, prefix, name), mmap_mode = mmap_mode)
+            for name in ARRAYS
+        ])
+
+    def sample(self, origin_ids, random):
+        origin_indices = self.get_indices(self.zone_ids, origin_ids)
+        f = origin_indices < 0
+
+        if np.any(f):
+            raise RuntimeError("Unknown origin zones: %s" % ", ".join(map(str, np.unique(np.asarray(origin_ids)[f]))))
+
+        starts = self.indptr[origin_indices]
+        counts = self.indptr[origin_indices + 1] - starts
+        f = counts == 0
+
+        if np.any(f):
+            raise RuntimeError("No destinations available for origin zones: %s" % ", ".join(map(str, np.unique(np.asarray(origin_ids)[f]))))
+
+        # Shifting every row by its index makes the per-row distributions one
+        # increasing sequence, so all draws are resolved by one binary search
+        keys = self.cdf + np.repeat(np.arange(len(self.zone_ids)), self.get_counts())
+        u = random.random(size = (len(origin_indices),))
+
+        positions = np.searchsorted(keys, origin_indices + u, side = "right")
+        positions = np.minimum(np.maximum(positions, starts), starts + counts - 1)
+
+        return self.zone_ids[self.indices[positions]]
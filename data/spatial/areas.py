@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import data.spatial.utils
+
+def configure(context):
+    context.stage("data.spatial.zones")
+    context.config("data_path")
+    context.config("shapefile_center_name")
+    context.config("shapefile_city_name")
+
+def read_area(context, shapefile_option):
+    df_area = gpd.read_file("%s/Spatial/%s" % (context.config("data_path"), context.config(shapefile_option)))
+    df_area.crs = {"init":"epsg:4326"}
+    df_area["AP_2010_CH"] = df_area["AP_2010_CH"].astype(np.int)
+    return df_area
+
+def execute(context):
+    df_center = read_area(context, "shapefile_center_name")
+    df_city = read_area(context, "shapefile_city_name")
+    df_zones = context.stage("data.spatial.zones")
+
+    center = np.unique(df_center["AP_2010_CH"].values)
+    city = np.unique(df_city["AP_2010_CH"].values)
+    region = np.unique(df_zones["zone_id"].values)
+
+    # Classification table: 3 in the city center, 2 in the Sao-Paulo city and 1 otherwise
+    zone_ids = np.unique(np.concatenate([center, city, region])).astype(np.int64)
+
+    df_areas = pd.DataFrame(dict(
+        zone_id = zone_ids,
+        residence_area_index = data.spatial.utils.impute_residence_area_index(zone_ids, center, city, region).astype(np.int8)
+    ))
+
+    # The city polygons are also needed by the simulation preparation
+    df_city = df_city.to_crs({"init":"epsg:29183"})
+
+    return df_areas, df_city
@@ -7,12 +7,7 @@ from sklearn.neighbors import KDTree
 import multiprocessing as mp
 
 def to_gpd(df, x = "x", y = "y", crs = {"init" : "EPSG:29183"}):
-    df["geometry"] = [
-        geo.Point(*coord) for coord in tqdm(
-            zip(df[x], df[y]), total = len(df),
-            desc = "Converting coordinates"
-        )]
-    df = gpd.GeoDataFrame(df)
+    df = gpd.GeoDataFrame(df, geometry = gpd.points_from_xy(df[x].values, df[y].values))
     df.crs = crs
 
     if not crs == {"init" : "EPSG:29183"}:
@@ -56,3 +51,16 @@ def impute(df_points, df_zones, point_id_field, zone_id_field, fix_by_distance =
         df_points.loc[invalid_mask, zone_id_field] = df_zones.iloc[indices][zone_id_field].values
 
     return pd.merge(df_original, df_points[[point_id_field, zone_id_field]], on = point_id_field, how = "left")
+
+def impute_residence_area_index(zone_ids, center_zone_ids, city_zone_ids, region_zone_ids):
+    # 3 in the city center, 2 in the Sao-Paulo city and 1 otherwise
+    in_center = np.isin(zone_ids, center_zone_ids)
+    in_city = np.isin(zone_ids, city_zone_ids)
+    in_region = np.isin(zone_ids, region_zone_ids)
+
+    return 3 * in_center + 2 * (in_city & ~in_center) + 1 * (in_region & ~in_city)
+
+def get_residence_area_index(df_areas, zone_ids):
+    # Hashed lookup in the classification table of data.spatial.areas, unknown zones get 0
+    indices = pd.Index(df_areas["zone_id"].values).get_indexer(zone_ids)
+    return np.where(indices >= 0, df_areas["residence_area_index"].values[indices], 0).astype(np.int8)
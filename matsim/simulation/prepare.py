@@ -1,6 +1,5 @@
 import shutil
 import os.path
-import geopandas as gpd
 import matsim.runtime.eqasim as eqasim
 
 def configure(context):
@@ -14,11 +13,12 @@ def configure(context):
     context.stage("matsim.runtime.java")
     context.stage("matsim.runtime.eqasim")
 
+    context.stage("data.spatial.areas")
+
     context.config("sampling_rate")
     context.config("processes")
     context.config("random_seed")
     context.config("data_path")
-    context.config("shapefile_city_name")
 
 def execute(context):
     # Prepare input files
@@ -39,9 +39,7 @@ def execute(context):
 
     sp_path = "%s/Spatial/SC2010_RMSP_CEM_V3_center_transformed.shp" % context.config("data_path")
     
-    df_zones_census = gpd.read_file("%s/Spatial/%s" % (context.config("data_path"), context.config("shapefile_city_name")))
-    df_zones_census.crs = {"init":"epsg:4326"}
-    df_zones_census = df_zones_census.to_crs({"init":"epsg:29183"})
+    df_zones_census = context.stage("data.spatial.areas")[1]
     df_zones_census.to_file("%s/Spatial/SC2010_RMSP_CEM_V3_center_transformed.shp" % context.config("data_path"))
     eqasim.run(context, "org.eqasim.core.scenario.preparation.RunPreparation", [
         "--input-facilities-path", facilities_path,
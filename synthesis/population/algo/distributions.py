@@ -0,0 +1,115 @@
+"""
+    Weighted empirical distributions with precomputed cumulative distribution
+    functions. Values are drawn in batches by binary search, using the random
+    state or generator that is passed in.
+"""
+
+import numpy as np
+
+def make_cdf(weights, offsets):
+    # Cumulative distribution per segment of a flat weight array, each
+    # segment ends with exactly one
+    counts = np.diff(offsets)
+    segments = np.repeat(np.arange(len(counts)), counts)
+
+    cumulative = np.concatenate([[0.0], np.cumsum(weights, dtype = np.float64)])
+    totals = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+    for segment in np.where(~(totals > 0.0))[0]:
+        raise RuntimeError("Segment %d of the distribution has no positive weight" % segment)
+
+    return (cumulative[1:] - cumulative[offsets[:-1]][segments]) / totals[segments]
+
+class EmpiricalDistribution:
+    def __init__(self, values, cdf):
+        self.values = values
+        self.cdf = cdf
+
+    @classmethod
+    def from_samples(cls, values, weights):
+        sorter = np.argsort(values, kind = "stable")
+        values, weights = np.asarray(values)[sorter], np.asarray(weights, dtype = np.float64)[sorter]
+        return cls(values, make_cdf(weights, np.array([0, len(values)])))
+
+    @classmethod
+    def from_histogram(cls, values, weights, bins = 500):
+        hist, bins = np.histogram(values, weights = weights, bins = bins)
+        return cls(bins[:-1] + np.diff(bins) / 2, make_cdf(hist, np.array([0, len(hist)])))
+
+    def sample(self, size, random):
+        indices = np.searchsorted(self.cdf, random.random(size = size))
+        return self.values[np.minimum(indices, len(self.values) - 1)]
+
+class ConditionalDistributionTable:
+    """
+        One empirical distribution per band of a conditioning variable. The
+        values and cumulative weights of all bands are stored in flat arrays,
+        band i covering the range offsets[i] to offsets[i + 1]. A value x
+        falls into the first band with x <= bounds[i].
+    """
+    def __init__(self, bounds, values, cdf, offsets):
+        self.bounds = bounds
+        self.values = values
+        self.cdf = cdf
+        self.offsets = offsets
+
+        # Shifting every band by its index makes the flat array increasing,
+        # so all draws are resolved by one binary search
+        self.shifted_cdf = cdf + self.get_bands()
+
+    @classmethod
+    def from_samples(cls, conditions, values, weights, bounds):
+        bounds = np.asarray(bounds, dtype = np.float64)
+        bands = np.searchsorted(bounds, conditions)
+
+        # Sort by band and by value within each band
+        sorter = np.lexsort((values, bands))
+        bands, values, weights = bands[sorter], np.asarray(values)[sorter], np.asarray(weights, dtype = np.float64)[sorter]
+
+        offsets = np.searchsorted(bands, np.arange(len(bounds) + 1))
+
+        totals = np.bincount(bands, weights = weights, minlength = len(bounds) + 1)[:len(bounds)]
+        cls.check_bands(bounds, totals)
+
+        return cls(bounds, values[:offsets[-1]], make_cdf(weights[:offsets[-1]], offsets), offsets)
+
+    @staticmethod
+    def check_bands(bounds, totals):
+        # Bands without weight cannot be sampled and would silently fall back
+        # to the values of the next band
+        for band in np.where(~(totals > 0.0))[0]:
+            raise RuntimeError("Band %d of the distribution (conditions up to %s) has no positive weight" % (band, bounds[band]))
+
+    def get_bands(self):
+        return np.repeat(np.arange(len(self.bounds)), np.diff(self.offsets))
+
+    def get_distribution(self, band):
+        start, end = self.offsets[band], self.offsets[band + 1]
+        return EmpiricalDistribution(self.values[start:end], self.cdf[start:end])
+
+    def sample(self, conditions, random):
+        bands = np.minimum(np.searchsorted(self.bounds, conditions), len(self.bounds) - 1)
+        u = random.random(size = (len(bands),))
+
+        indices = np.searchsorted(self.shifted_cdf, bands + u)
+        indices = np.minimum(np.maximum(indices, self.offsets[bands]), self.offsets[bands + 1] - 1)
+
+        return self.values[indices]
+
+    def resample(self, factor):
+        # Tilts the distribution of each band towards the larger values
+        # (factor > 0) or towards the smaller values (factor < 0)
+        bands = self.get_bands()
+        counts = np.diff(self.offsets)
+        ranks = (np.arange(len(self.cdf)) - self.offsets[bands] + 1) / counts[bands]
+
+        if factor >= 0.0:
+            cdf = self.cdf * (1.0 + factor * ranks)
+        else:
+            cdf = self.cdf * (1.0 + abs(factor) - abs(factor) * ranks)
+
+        totals = np.where(counts > 0, cdf[np.maximum(self.offsets[1:] - 1, 0)], 0.0) if len(cdf) > 0 else np.zeros((len(counts),))
+        self.check_bands(self.bounds, totals)
+
+        cdf /= totals[bands]
+        return ConditionalDistributionTable(self.bounds, self.values, cdf, self.offsets)
@@ -0,0 +1,39 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+def query(tree, points, k, workers = -1):
+    # Parallel queries are called "workers" in recent SciPy versions and
+    # "n_jobs" in older ones. Inside of a process pool, workers should be 1
+    # to avoid starting one thread per core in every process.
+    try:
+        return tree.query(points, k = k, workers = workers)
+    except TypeError:
+        return tree.query(points, k = k, n_jobs = workers)
+
+class FacilitySampler:
+    """
+        Finds facilities at approximately a given distance from an origin. A
+        point is placed on the circle with the requested radius around the
+        origin in a random direction, and among the facilities closest to
+        that point the one with the distance closest to the radius is chosen.
+    """
+    def __init__(self, coordinates, candidates = 10, workers = -1):
+        self.coordinates = np.asarray(coordinates, dtype = np.float64)
+        self.candidates = min(candidates, len(self.coordinates))
+        self.workers = workers
+        self.tree = cKDTree(self.coordinates)
+
+    def sample(self, origins, distances, random = np.random):
+        origins = np.asarray(origins, dtype = np.float64).reshape((-1, 2))
+        distances = np.asarray(distances, dtype = np.float64)
+
+        angles = random.random(size = (len(origins),)) * 2.0 * np.pi
+        targets = origins + distances[:, np.newaxis] * np.vstack([np.cos(angles), np.sin(angles)]).T
+
+        _, indices = query(self.tree, targets, self.candidates, self.workers)
+        indices = indices.reshape((len(origins), self.candidates))
+
+        candidate_distances = np.sqrt(np.sum((self.coordinates[indices] - origins[:, np.newaxis, :])**2, axis = 2))
+        selection = np.argmin(np.abs(candidate_distances - distances[:, np.newaxis]), axis = 1)
+
+        return indices[np.arange(len(origins)), selection]
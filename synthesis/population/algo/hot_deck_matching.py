@@ -1,17 +1,19 @@
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-import functools, itertools
+import itertools
 import multiprocessing as mp
-import numpy.ma as ma
+from synthesis.population.algo.shared import SharedArray
+import synthesis.population.algo.random_streams as random_streams
 
 class HotDeckMatcher:
-    def __init__(self, df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id, minimum_source_samples):
+    def __init__(self, df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id, minimum_source_samples, weighted = False):
         self.mandatory_fields = mandatory_fields
         self.preference_fields = preference_fields
         self.all_fields = self.mandatory_fields + self.preference_fields
         self.default_id = default_id
         self.minimum_source_samples = minimum_source_samples
+        self.weighted = weighted
 
         self.values = {
             field : list(np.unique(df_source[field]))
@@ -19,115 +21,205 @@ class HotDeckMatcher:
         }
 
         self.field_sizes = [len(self.values[field]) for field in self.all_fields]
-        self.field_indices = np.cumsum(self.field_sizes)
 
         for field in self.all_fields:
             print("Found categories for %s:" % field, ", ".join([str(c) for c in self.values[field]]))
 
-        self.source_matrix = self.make_matrix(df_source, source = True)
-        self.source_weights = df_source[source_weight]
+        # Each person is described by one combined code of all fields (mixed
+        # radix), with one additional digit value per field for unknown values.
+        self.field_radices = [size + 1 for size in self.field_sizes]
+        self.field_strides = np.cumprod([1] + self.field_radices[:-1]).astype(np.int64)
+
+        # The smallest integer type that fits all combinations is used
+        self.code_dtype = np.dtype(np.int64)
+        code_count = int(np.prod(self.field_radices, dtype = np.float64))
+
+        for candidate in (np.int8, np.int16, np.int32):
+            if code_count - 1 <= np.iinfo(candidate).max:
+                self.code_dtype = np.dtype(candidate)
+                break
+
+        self.source_codes = self.make_codes(df_source)
+        self.source_weights = df_source[source_weight].values.astype(np.float64)
         self.source_ids = df_source[source_id]
 
-        search_order = [
-            [list(np.arange(size) == k) for k in range(size)] +
-            ([] if field in self.mandatory_fields else [[False] * size])
-            for field, size in zip(self.all_fields, self.field_sizes)
+        # The search order first tries to match all preference fields and then
+        # gives them up one after another, the last field being dropped first.
+        # This is the same order in which the exhaustive search over all
+        # category combinations used to find a match.
+        self.field_patterns = [
+            np.array([True] * len(self.mandatory_fields) + [not dropped for dropped in pattern], dtype = np.bool)
+            for pattern in itertools.product([False, True], repeat = len(self.preference_fields))
         ]
 
-        self.field_masks = list(itertools.product(*search_order))
+        self.source_index = [self.make_index(pattern) for pattern in self.field_patterns]
 
-    def make_matrix(self, df, chunk_index = None, source = False):
-        columns = sum(self.field_sizes)
+    def make_codes(self, df):
+        # One combined code per person, built from the category codes of the
+        # fields without intermediate copies in a wider integer type
+        codes = np.zeros((len(df),), dtype = self.code_dtype)
 
-        matrix = np.zeros((len(df), columns), dtype = np.bool)
-        column_index = 0
+        for field_name, size, stride in zip(self.all_fields, self.field_sizes, self.field_strides):
+            field_codes = pd.Categorical(df[field_name].values, categories = self.values[field_name]).codes
+            field_codes = np.where(field_codes < 0, size, field_codes).astype(self.code_dtype)
 
-        with tqdm(total = columns, desc = "Reading categories (%s) ..." % ("source" if source else "target"), position = chunk_index) as progress:
-            for field_name in self.all_fields:
-                for field_value in self.values[field_name]:
-                    matrix[:, column_index] = df[field_name] == field_value
-                    column_index += 1
-                    progress.update()
+            field_codes *= self.code_dtype.type(stride)
+            codes += field_codes
 
-        return matrix
+        return codes
 
-    def __call__(self, df_target, chunk_index = 0):
-        target_matrix = self.make_matrix(df_target, chunk_index = None)
+    def make_keys(self, codes, pattern):
+        # Removes the inactive fields from the combined codes, rows with an
+        # unknown value in one of the active fields get -1
+        keys = codes.copy()
+        valid = np.ones((len(codes),), dtype = np.bool)
 
-        matched_mask = np.zeros((len(df_target),), dtype = np.bool)
-        matched_indices = np.ones((len(df_target), ), dtype = np.int) * -1
+        for active, size, radix, stride in zip(pattern, self.field_sizes, self.field_radices, self.field_strides):
+            digits = (codes // self.code_dtype.type(stride)) % self.code_dtype.type(radix)
 
-        # Note: This speeds things up quite a bit. We generate a random number
-        # for each person which is later on used for the sampling.
-        random = np.array([
-            np.random.random() for _ in tqdm(range(len(df_target)), desc = "Generating random numbers", position = chunk_index)
-        ])
+            if active:
+                valid &= digits < size
+            else:
+                digits *= self.code_dtype.type(stride)
+                keys -= digits
 
-        with tqdm(total = len(self.field_masks), position = chunk_index, desc = "Hot Deck Matching") as progress:
-            for field_mask in self.field_masks:
-                field_mask = np.array(functools.reduce(lambda x, y: x + y, field_mask), dtype = np.bool)
-                source_mask = np.all(self.source_matrix[:, field_mask], axis = 1)
+        keys[~valid] = -1
+        return keys
 
-                if np.any(source_mask) and np.count_nonzero(source_mask) >= self.minimum_source_samples:
-                    target_mask = np.all(target_matrix[:,field_mask], axis = 1)
+    def make_index(self, pattern):
+        keys = self.make_keys(self.source_codes, pattern)
 
-                    if np.any(target_mask):
-                        source_indices = np.where(source_mask)[0]
-                        random_indices = np.floor(random[target_mask] * len(source_indices)).astype(np.int)
-                        matched_indices[np.where(~matched_mask)[0][target_mask]] = source_indices[random_indices]
+        # Sort source observations by key, the stable sort keeps them in their
+        # original order within each cell
+        order = np.argsort(keys, kind = "stable")
+        order = order[keys[order] >= 0]
 
-                        # We continuously shrink these matrix to make the matching
-                        # easier and easier as the HDM proceeds
-                        random = random[~target_mask]
-                        target_matrix = target_matrix[~target_mask]
-                        matched_mask[~matched_mask] |= target_mask
+        cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index = True, return_counts = True)
 
-                progress.update()
+        f = cell_counts >= max(1, self.minimum_source_samples)
+        index = dict(order = order, keys = cell_keys[f], starts = cell_starts[f], counts = cell_counts[f])
 
-        matched_ids = np.zeros((len(df_target),), dtype = self.source_ids.dtype)
-        matched_ids[matched_mask] = self.source_ids.iloc[matched_indices[matched_mask]]
-        matched_ids[~matched_mask] = self.default_id
+        if self.weighted:
+            # One cumulative weight table over all sorted observations. Each
+            # cell covers a contiguous range, described by the cumulative
+            # weight before its first observation and its total weight.
+            weights = self.source_weights[order]
+            cumulative_weights = np.cumsum(weights)
 
-        return matched_ids
+            index["cumulative_weights"] = cumulative_weights
+            index["bases"] = cumulative_weights[index["starts"]] - weights[index["starts"]]
+            index["totals"] = cumulative_weights[index["starts"] + index["counts"] - 1] - index["bases"]
 
-def run(df_target, target_id, df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id = int(-1), runners = -1, minimum_source_samples = 1):
-    matcher = HotDeckMatcher(df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id, minimum_source_samples)
+        return index
 
-    if runners == -1:
-        runners = mp.cpu_count()
+    def sample(self, index, cells, random):
+        # Returns positions in the sorted source order for the given cells
+        starts, counts = index["starts"][cells], index["counts"][cells]
 
-    if runners == 1:
-        df_target.loc[:, "hdm_source_id"] = matcher(df_target, 0)
-    else:
-        with mp.Pool(processes = runners, initializer = initializer, initargs = (matcher,)) as pool:
-            chunks = np.array_split(df_target, runners)
-            df_target.loc[:, "hdm_source_id"] = np.hstack(pool.map(runner, enumerate(chunks)))
+        if self.weighted:
+            positions = np.searchsorted(index["cumulative_weights"], index["bases"][cells] + random * index["totals"][cells], side = "right")
+            return np.minimum(np.maximum(positions, starts), starts + counts - 1)
 
-            for i in range(runners + 1): print(" ") # Formatting of output
+        else:
+            return starts + np.floor(random * counts).astype(np.int64)
 
-matcher = None
-def initializer(_matcher):
-    global matcher
-    matcher = _matcher
+    def __getstate__(self):
+        # Workers only need the cell index. The source data stays in the
+        # main process and the target codes are shared through memory.
+        state = dict(self.__dict__)
+        state["source_codes"] = None
+        state["source_weights"] = None
+        state["source_ids"] = None
+        return state
 
-def runner(args):
-    index, df_chunk = args
-    return matcher(df_chunk, index)
+    def match(self, target_codes, random, chunk_index = 0):
+        # Returns the matched source row per target row, or -1
+        matched_indices = np.ones((len(target_codes), ), dtype = np.int64) * -1
+
+        # Only the rows that are still unmatched are encoded in every step
+        remaining = np.arange(len(target_codes))
+
+        for pattern, index in tqdm(zip(self.field_patterns, self.source_index), total = len(self.field_patterns), position = chunk_index, desc = "Hot Deck Matching"):
+            if len(remaining) == 0 or len(index["keys"]) == 0:
+                continue
+
+            keys = self.make_keys(target_codes[remaining], pattern)
 
+            cells = np.minimum(np.searchsorted(index["keys"], keys), len(index["keys"]) - 1)
+            f = index["keys"][cells] == keys
+            f &= keys >= 0
 
+            positions = self.sample(index, cells[f], random[remaining[f]])
+            matched_indices[remaining[f]] = index["order"][positions]
 
+            remaining = remaining[~f]
 
+        return matched_indices
 
+    def make_ids(self, matched_indices):
+        matched_mask = matched_indices >= 0
 
+        matched_ids = np.zeros((len(matched_indices),), dtype = self.source_ids.dtype)
+        matched_ids[matched_mask] = self.source_ids.iloc[matched_indices[matched_mask]]
+        matched_ids[~matched_mask] = self.default_id
+
+        return matched_ids
+
+    def __call__(self, df_target, random, chunk_index = 0):
+        target_codes = self.make_codes(df_target)
+
+        # Note: This speeds things up quite a bit. We generate a random number
+        # for each person which is later on used for the sampling.
+        random = random.random(size = (len(df_target),))
 
+        return self.make_ids(self.match(target_codes, random, chunk_index))
 
+def run(df_target, target_id, df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id = int(-1), runners = -1, minimum_source_samples = 1, weighted = False, random_seed = None):
+    matcher = HotDeckMatcher(df_source, source_id, source_weight, mandatory_fields, preference_fields, default_id, minimum_source_samples, weighted)
 
+    if runners == -1:
+        runners = mp.cpu_count()
+
+    # The random numbers are drawn for all targets at once in the main process
+    random = random_streams.get_generator(random_seed, "hot_deck_matching", target_id)
+
+    if runners == 1:
+        df_target.loc[:, "hdm_source_id"] = matcher(df_target, random, 0)
+    else:
+        # Category codes, random numbers and results are kept in shared memory,
+        # the workers only receive the offsets of the block they should process.
+        # The memory blocks are released even if a worker fails.
+        shared = []
 
+        try:
+            target_codes = SharedArray.from_array(matcher.make_codes(df_target))
+            shared.append(target_codes)
 
+            target_random = SharedArray.from_array(random.random(size = (len(df_target),)))
+            shared.append(target_random)
 
+            matched_indices = SharedArray((len(df_target),), np.int64)
+            shared.append(matched_indices)
 
+            offsets = np.linspace(0, len(df_target), runners + 1).astype(np.int64)
+            blocks = list(enumerate(zip(offsets[:-1], offsets[1:])))
 
+            with mp.Pool(processes = runners, initializer = initializer, initargs = (matcher, target_codes, target_random, matched_indices)) as pool:
+                pool.map(runner, blocks)
+                for i in range(runners + 1): print(" ") # Formatting of output
 
+            df_target.loc[:, "hdm_source_id"] = matcher.make_ids(matched_indices.array)
 
+        finally:
+            for array in shared:
+                array.unlink()
 
-#
+matcher, target_codes, target_random, matched_indices = None, None, None, None
+def initializer(_matcher, _target_codes, _target_random, _matched_indices):
+    global matcher, target_codes, target_random, matched_indices
+    matcher, target_codes, target_random, matched_indices = _matcher, _target_codes, _target_random, _matched_indices
+
+def runner(args):
+    index, (start, end) = args
+    matched_indices.array[start:end] = matcher.match(
+        target_codes.array[start:end], target_random.array[start:end], index)
@@ -0,0 +1,82 @@
+import numpy as np
+import shapely.geometry as geo
+import shapely.ops
+
+try:
+    from shapely import contains_xy
+except ImportError:
+    from shapely.vectorized import contains as contains_xy
+
+class PolygonSampler:
+    """
+        Samples uniformly distributed points inside of zone polygons. Each zone
+        is triangulated once and the triangulation is cached by zone id.
+
+        The triangles come from a Delaunay triangulation of the polygon
+        vertices, so they may reach outside of non-convex polygons. Triangles
+        are therefore chosen by their full area, and points in triangles that
+        are not fully covered are rejected if they fall outside of the
+        polygon. Triangles without any overlap are left out. The accepted
+        points are uniformly distributed over the polygon.
+    """
+    def __init__(self, oversampling = 1.2):
+        self.oversampling = oversampling
+        self.triangulations = {}
+
+    def triangulate(self, zone_id, shape):
+        if zone_id in self.triangulations:
+            return self.triangulations[zone_id]
+
+        vertices, areas, partial = [], [], []
+
+        for triangle in shapely.ops.triangulate(shape):
+            area = triangle.intersection(shape).area
+
+            if area > 0.0:
+                vertices.append(np.array(triangle.exterior.coords)[:3])
+                areas.append(triangle.area)
+                partial.append(area < triangle.area * (1.0 - 1e-9))
+
+        if len(vertices) == 0:
+            raise RuntimeError("Cannot sample points in zone %s without area" % zone_id)
+
+        cdf = np.cumsum(areas)
+        cdf /= cdf[-1]
+
+        triangulation = dict(
+            shape = shape, vertices = np.array(vertices), cdf = cdf,
+            partial = np.array(partial, dtype = np.bool)
+        )
+
+        self.triangulations[zone_id] = triangulation
+        return triangulation
+
+    def sample(self, zone_id, shape, count, random = np.random):
+        triangulation = self.triangulate(zone_id, shape)
+        points = []
+
+        while count > 0:
+            size = int(np.ceil(count * self.oversampling))
+
+            triangles = np.minimum(np.searchsorted(triangulation["cdf"], random.random(size = (size,)), side = "right"), len(triangulation["cdf"]) - 1)
+            vertices = triangulation["vertices"][triangles]
+
+            # Uniform points in the triangles, points of the mirrored half of
+            # the parallelogram are reflected back
+            u = random.random(size = (size, 2))
+            f = np.sum(u, axis = 1) > 1.0
+            u[f] = 1.0 - u[f]
+
+            candidates = vertices[:,0] + u[:,0][:, np.newaxis] * (vertices[:,1] - vertices[:,0]) + u[:,1][:, np.newaxis] * (vertices[:,2] - vertices[:,0])
+
+            f = triangulation["partial"][triangles]
+            accepted = np.ones((size,), dtype = np.bool)
+
+            if np.any(f):
+                accepted[f] = contains_xy(triangulation["shape"], candidates[f, 0], candidates[f, 1])
+
+            candidates = candidates[accepted][:count]
+            points.append(candidates)
+            count -= len(candidates)
+
+        return np.vstack(points) if len(points) > 0 else np.zeros((0, 2))
@@ -0,0 +1,39 @@
+"""
+    Reproducible random streams. Every stream is derived from the global
+    random seed, a stage or purpose name and optional entity keys (for
+    instance a block of persons or a zone), but never from the worker that
+    processes it. Results therefore do not depend on the number of processes.
+"""
+
+import zlib
+import numpy as np
+
+# Number of entities per block for which one stream is created
+BLOCK_SIZE = 10000
+
+# Smaller blocks for expensive per-entity work, such that small samples are
+# still spread over all processes
+SMALL_BLOCK_SIZE = 1000
+
+def get_seed_sequence(random_seed, name, *keys):
+    entropy = np.random.SeedSequence().entropy if random_seed is None else int(random_seed)
+
+    # Names are hashed, such that streams do not change when stages are added
+    spawn_key = [zlib.crc32(name.encode("utf-8"))]
+
+    for key in keys:
+        spawn_key.append(zlib.crc32(key.encode("utf-8")) if isinstance(key, str) else int(key))
+
+    return np.random.SeedSequence(entropy, spawn_key = spawn_key)
+
+def get_generator(random_seed, name, *keys):
+    return np.random.Generator(np.random.PCG64(get_seed_sequence(random_seed, name, *keys)))
+
+def get_random_state(random_seed, name, *keys):
+    # For code that relies on the RandomState interface (random_sample, ...)
+    return np.random.RandomState(np.random.MT19937(get_seed_sequence(random_seed, name, *keys)))
+
+def get_blocks(count, block_size = BLOCK_SIZE):
+    # Contiguous (start, end) ranges of entities, independent of the workers
+    offsets = np.append(np.arange(0, count, block_size), count)
+    return list(zip(offsets[:-1], offsets[1:]))
@@ -0,0 +1,40 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedArray:
+    """
+        NumPy array that lives in shared memory. When passed to a worker
+        process only the name of the memory block is transferred, the worker
+        then attaches to the same data without copying it.
+    """
+    def __init__(self, shape, dtype, name = None):
+        self.shape = tuple(np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+
+        if name is None:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.memory = shared_memory.SharedMemory(create = True, size = size)
+        else:
+            self.memory = shared_memory.SharedMemory(name = name)
+
+        self.array = np.ndarray(self.shape, dtype = self.dtype, buffer = self.memory.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        shared = cls(array.shape, array.dtype)
+        shared.array[:] = array
+        return shared
+
+    def __getstate__(self):
+        return dict(shape = self.shape, dtype = self.dtype.str, name = self.memory.name)
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["dtype"], state["name"])
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+
+    def unlink(self):
+        self.close()
+        self.memory.unlink()
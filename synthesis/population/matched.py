@@ -6,6 +6,10 @@ def configure(context):
     context.stage("synthesis.population.sampled")
     context.stage("data.hts.cleaned")
     context.config("processes")
+    context.config("random_seed")
+
+    # Donors are drawn uniformly per cell unless weighted matching is enabled
+    context.config("weighted_matching", False)
 
 MINIMUM_SOURCE_SAMPLES = 20
 
@@ -37,7 +41,9 @@ def execute(context):
         ["age_class", "sex", "binary_car_availability","employment"],
         ["residence_area_index"],
         runners = number_of_threads,
-        minimum_source_samples = 5
+        minimum_source_samples = 5,
+        weighted = context.config("weighted_matching"),
+        random_seed = context.config("random_seed")
     )
 
     # Remove and track unmatchable persons
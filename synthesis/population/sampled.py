@@ -1,47 +1,50 @@
 import pandas as pd
 import numpy as np
+import synthesis.population.algo.random_streams as random_streams
 
 def configure(context):
     context.stage("data.census.cleaned")
     context.config("sampling_rate")
+    context.config("random_seed")
 
 def execute(context):
-    df_census = context.stage("data.census.cleaned").sort_values(by = "household_id")
+    df_census = context.stage("data.census.cleaned").sort_values(by = "household_id", kind = "mergesort")
     df_census["household_size"] = df_census["household_size"].astype(np.int)
-    # Find rounded multiplicators for the households
-    df_weighting = df_census[[
-        "household_id", "weight", "household_size"
-    ]].groupby("household_id").first().reset_index()
-    df_weighting["multiplicator"] = np.round(df_weighting["weight"]).astype(np.int)
-    df_weighting = df_weighting[["household_id", "multiplicator", "household_size"]]
-
-    household_multiplicators = df_weighting["multiplicator"].values
-    household_sizes = df_weighting["household_size"].values
 
-    person_muliplicators = np.repeat(household_multiplicators, household_sizes)
-    df_census = df_census.iloc[np.repeat(np.arange(len(df_census)), person_muliplicators)]
-
-    # Create new houeshold and person IDs
-    df_census.loc[:, "census_person_id"] = df_census["person_id"]
-    df_census.loc[:, "census_household_id"] = df_census["household_id"]
-    df_census.loc[:, "person_id"] = np.arange(len(df_census))
+    # Households are contiguous after sorting, so each one is described by the
+    # position of its first person and its number of persons
+    household_ids, household_starts, household_sizes = np.unique(
+        df_census["household_id"].values, return_index = True, return_counts = True)
 
-    multiplied_household_sizes = np.repeat(household_sizes, household_multiplicators)
-    multiplied_household_count = int(np.sum(household_multiplicators))
-    df_census.loc[:, "household_id"] = np.repeat(np.arange(multiplied_household_count), multiplied_household_sizes)
+    # Find rounded multiplicators for the households
+    household_multiplicators = np.round(df_census["weight"].values[household_starts]).astype(np.int)
+    print("  Initial number of households:", np.sum(household_multiplicators))
 
     if context.config("sampling_rate"):
         probability = context.config("sampling_rate")
         print("Downsampling (%f)" % probability)
 
-        household_ids = np.unique(df_census["household_id"])
-        print("  Initial number of households:", len(household_ids))
+        # Keeping each of the m replicas of a household with probability p is
+        # the same as drawing the number of kept replicas from Binomial(m, p),
+        # so only the surviving replicas need to be created.
+        random = random_streams.get_generator(context.config("random_seed"), "synthesis.population.sampled")
+        household_multiplicators = random.binomial(household_multiplicators, probability)
 
-        f = np.random.random(size = (len(household_ids),)) < probability
-        remaining_household_ids = household_ids[f]
-        print("  Sampled number of households:", len(remaining_household_ids))
+    print("  Sampled number of households:", np.sum(household_multiplicators))
 
-        df_census = df_census[df_census["household_id"].isin(remaining_household_ids)]
+    # Every replica of a household contains all of its persons
+    replica_households = np.repeat(np.arange(len(household_ids)), household_multiplicators)
+    replica_sizes = household_sizes[replica_households]
 
-    return df_census
+    replica_offsets = np.cumsum(replica_sizes) - replica_sizes
+    member_indices = np.arange(np.sum(replica_sizes)) - np.repeat(replica_offsets, replica_sizes)
+
+    df_census = df_census.iloc[np.repeat(household_starts[replica_households], replica_sizes) + member_indices].copy()
+
+    # Create new houeshold and person IDs
+    df_census.loc[:, "census_person_id"] = df_census["person_id"]
+    df_census.loc[:, "census_household_id"] = df_census["household_id"]
+    df_census.loc[:, "person_id"] = np.arange(len(df_census))
+    df_census.loc[:, "household_id"] = np.repeat(np.arange(len(replica_households)), replica_sizes)
 
+    return df_census
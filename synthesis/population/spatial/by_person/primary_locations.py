@@ -5,12 +5,16 @@ import numpy as np
 #import data.constants as c
 import shapely.geometry as geo
 import multiprocessing as mp
-from sklearn.neighbors import KDTree
 import matplotlib.pyplot as plt
 import geopandas as gpd
 from scipy.spatial import cKDTree
-from functools import partial
+from scipy.optimize import linear_sum_assignment
 import time
+from synthesis.population.algo.polygon_sampling import PolygonSampler
+from synthesis.population.algo.shared import SharedArray
+from synthesis.population.algo.facility_sampling import FacilitySampler
+from synthesis.population.algo.distributions import EmpiricalDistribution
+import synthesis.population.algo.random_streams as random_streams
 
 #import data.spatial.pt_zone
 
@@ -23,297 +27,331 @@ def configure(context):
     context.stage("synthesis.population.trips")
     context.stage("synthesis.destinations")
     context.config("processes")
+    context.config("random_seed")
     context.stage("data.hts.cleaned")
 
-SAMPLE_SIZE = 1000
+    # Ordering of work locations within a zone, see ORDERINGS
+    context.config("work_ordering", "heuristic")
 
-def initialize_parallel(_df_persons, _df_locations):
-    global df_persons, df_locations
-    df_persons = pd.DataFrame(_df_persons, copy = True)
-    df_locations = pd.DataFrame(_df_locations, copy = True) if _df_locations is not None else None
+# Triangulations of the zones are cached here, they are created before the
+# worker processes are started such that all of them can reuse them
+polygon_sampler = PolygonSampler()
 
-def define_ordering(df_persons, commute_coordinates):
-    if "home_x" in df_persons.columns:
-        home_coordinates = df_persons[["home_x", "home_y"]].values
-        commute_distances = df_persons["commute_distance_work"].values
-        indices = heuristic_ordering(home_coordinates, commute_coordinates, commute_distances)
+STAGE_NAME = "synthesis.population.spatial.by_person.primary_locations"
+
+persons, locations = None, None
+def initialize_parallel(_persons, _locations):
+    global persons, locations
+    persons, locations = _persons, _locations
+
+def define_ordering(home_coordinates, commute_distances, commute_coordinates, ordering = "heuristic"):
+    if home_coordinates is not None:
+        indices = ORDERINGS[ordering](home_coordinates, commute_coordinates, commute_distances)
         assert((np.sort(np.unique(indices)) == np.arange(len(commute_distances))).all())
-        return indices
+
+        distances = np.sqrt(np.sum((commute_coordinates[indices] - home_coordinates)**2, axis = 1))
+        return indices, np.sum(np.abs(distances - commute_distances))
     else:
-        return np.arange(len(commute_coordinates)) # Random ordering
+        return np.arange(len(commute_coordinates)), 0.0 # Random ordering
+
+def get_ordering_costs(home_coordinates, commute_coordinates, commute_distances):
+    x = commute_coordinates[:,0][np.newaxis, :] - home_coordinates[:,0][:, np.newaxis]
+    y = commute_coordinates[:,1][np.newaxis, :] - home_coordinates[:,1][:, np.newaxis]
+    distances = np.sqrt(x**2 + y**2)
+    return np.abs(distances - commute_distances[:, np.newaxis])
 
 def heuristic_ordering(home_coordinates, commute_coordinates, commute_distances):
-    indices = []
-    commute_indices = np.arange(len(commute_coordinates))
+    indices = np.zeros((len(home_coordinates),), dtype = np.int64)
+    available = np.ones((len(commute_coordinates),), dtype = np.bool)
 
-    for home_coordinate, commute_distance in zip(home_coordinates, commute_distances):
+    for index, (home_coordinate, commute_distance) in enumerate(zip(home_coordinates, commute_distances)):
         distances = np.sqrt(np.sum((commute_coordinates - home_coordinate)**2, axis = 1))
         costs = np.abs(distances - commute_distance)
-        costs[indices] = np.inf
-        indices.append(np.argmin(costs))
+        costs[~available] = np.inf
+
+        indices[index] = np.argmin(costs)
+        available[indices[index]] = False
 
     return indices
 
-def bipartite_ordering(home_coordinates, commute_coordinates, commute_distances):
-    import munkres
-    x = commute_coordinates[:,0][np.newaxis, :] - home_coordinates[:,0][:, np.newaxis]
-    y = commute_coordinates[:,1][np.newaxis, :] - home_coordinates[:,1][:, np.newaxis]
-    distances = np.sqrt(x**2 + y**2)
-    costs = np.abs(distances - commute_distances[:, np.newaxis])
-    return [index[1] for index in munkres.Munkres().compute(costs)]
+# Maximum number of persons per sub-problem of the assignment ordering
+ASSIGNMENT_BLOCK_SIZE = 1000
+
+def assignment_ordering(home_coordinates, commute_coordinates, commute_distances):
+    # Minimises the total deviation from the commute distances. Large zones
+    # are split into blocks which are solved independently. The candidates are
+    # sampled independently of the persons, so each block of candidates is a
+    # random subset of all of them.
+    indices = np.zeros((len(home_coordinates),), dtype = np.int64)
+    blocks = np.array_split(np.arange(len(home_coordinates)), int(np.ceil(len(home_coordinates) / ASSIGNMENT_BLOCK_SIZE)))
+
+    for block in blocks:
+        costs = get_ordering_costs(home_coordinates[block], commute_coordinates[block], commute_distances[block])
+        rows, columns = linear_sum_assignment(costs)
+        indices[block[rows]] = block[columns]
+
+    return indices
+
+# Maximum number of persons per sub-problem of the greedy ordering
+GREEDY_BLOCK_SIZE = 1000
+
+def greedy_ordering(home_coordinates, commute_coordinates, commute_distances):
+    # Scalable variant of the heuristic ordering, which is quadratic in the
+    # number of persons of a zone. Like for the assignment ordering, large
+    # zones are split into blocks of persons and candidates, and each block
+    # is ordered by the heuristic, which makes it linear in the zone size.
+    indices = np.zeros((len(home_coordinates),), dtype = np.int64)
+    blocks = np.array_split(np.arange(len(home_coordinates)), int(np.ceil(len(home_coordinates) / GREEDY_BLOCK_SIZE)))
+
+    for block in blocks:
+        indices[block] = block[heuristic_ordering(home_coordinates[block], commute_coordinates[block], commute_distances[block])]
+
+    return indices
+
+ORDERINGS = dict(
+    heuristic = heuristic_ordering,
+    greedy = greedy_ordering,
+    assignment = assignment_ordering
+)
 
 def run_parallel(args):
-    i, chunk = args
-    person_dfs = []
+    i, (start, end), shapes, ordering, random_seed, name = args
+    objective = 0.0
+
+    zone_ids = persons["zone_ids"]
+    person_offsets = persons["offsets"].array
+    location_offsets = locations["offsets"].array if locations is not None else None
 
-    for zone_id, count, shape in tqdm(
-        chunk, desc = "Sampling coordinates", position = i):
+    home_coordinates = persons["home_coordinates"].array if persons["home_coordinates"] is not None else None
+    commute_distances = persons["commute_distances"].array if persons["commute_distances"] is not None else None
+
+    for zone_index in tqdm(range(start, end), desc = "Sampling coordinates", position = i):
+        zone_id = zone_ids[zone_index]
+        person_start, person_end = person_offsets[:, zone_index]
+        count = person_end - person_start
 
         if count > 0:
-            points = []
-            ids = []
-
-            if df_locations is None:
-                while len(points) < count:
-                    minx, miny, maxx, maxy = shape.bounds
-                    candidates = np.random.random(size = (SAMPLE_SIZE, 2))
-                    candidates[:,0] = minx + candidates[:,0] * (maxx - minx)
-                    candidates[:,1] = miny + candidates[:,1] * (maxy - miny)
-                    candidates = [geo.Point(*point) for point in candidates]
-                    candidates = [point for point in candidates if shape.contains(point)]
-                    points += candidates
-                    ids += [np.nan] * len(candidates)
-
-                points, ids = points[:count], ids[:count]
-                points = np.array([np.array([point.x, point.y]) for point in points])
+            # One stream per zone, such that the result does not depend on
+            # how the zones are distributed over the workers
+            random = random_streams.get_generator(random_seed, STAGE_NAME, name, zone_id)
+
+            if locations is None:
+                points = polygon_sampler.sample(zone_id, shapes[zone_index - start], count, random)
                 ids = np.array([np.nan] * len(points))
             else:
-                if np.count_nonzero(df_locations["zone_id"] == zone_id) == 0:
+                location_start, location_end = location_offsets[:, zone_index]
+
+                if location_end == location_start:
                     raise RuntimeError("Requested destination for a zone without discrete destinations")
 
-                df_zone_locations = df_locations[df_locations["zone_id"] == zone_id]
-                selector = np.random.randint(len(df_zone_locations), size = count)
+                selector = location_start + random.integers(location_end - location_start, size = count)
+
+                points = locations["coordinates"].array[selector]
+                ids = locations["ids"].array[selector]
 
-                points = df_zone_locations.iloc[selector][["x", "y"]].values
-                ids = df_zone_locations.iloc[selector]["location_id"].values
+            indices, zone_objective = define_ordering(
+                home_coordinates[person_start:person_end] if home_coordinates is not None else None,
+                commute_distances[person_start:person_end] if commute_distances is not None else None,
+                points, ordering)
 
-            f = df_persons["zone_id"] == zone_id
-            ordering = define_ordering(df_persons[f], points)
-            points, ids = points[ordering], ids[ordering]
-            df_persons.loc[f, "x"] = points[:,0]
-            df_persons.loc[f, "y"] = points[:,1]
-            df_persons.loc[f, "location_id"] = ids
-            person_dfs.append(df_persons[f])
+            persons["coordinates"].array[person_start:person_end] = points[indices]
+            persons["ids"].array[person_start:person_end] = ids[indices]
+            objective += zone_objective
 
     print() # Clean tqdm progress
-    return pd.concat(person_dfs) if len(person_dfs) > 0 else pd.DataFrame()
+    return objective
+
+def get_offsets(values, zone_ids):
+    # Values are sorted by zone, so each zone covers one range (start, end)
+    return np.vstack([
+        np.searchsorted(values, zone_ids, side = "left"),
+        np.searchsorted(values, zone_ids, side = "right")
+    ]).astype(np.int64)
+
+def impute_locations(df_persons, df_zones, df_locations, threads, identifier = "person_id", ordering = "heuristic", random_seed = None, name = "locations"):
+    if not ordering in ORDERINGS:
+        raise RuntimeError("Unknown ordering: %s" % ordering)
+
+    # Persons in zones without geometry are not imputed
+    df_persons = df_persons[df_persons["zone_id"].isin(df_zones["zone_id"])]
+    df_persons = df_persons.sort_values(by = "zone_id", kind = "mergesort")
+
+    zone_ids = np.unique(df_persons["zone_id"].values)
+
+    # Persons and locations are sorted by zone and described by offsets per
+    # zone. The arrays are published to the workers through shared memory.
+    persons = dict(zone_ids = zone_ids, offsets = get_offsets(df_persons["zone_id"].values, zone_ids))
+    persons["home_coordinates"], persons["commute_distances"] = None, None
+    locations = None
+
+    # The shared memory blocks are released even if a worker fails
+    try:
+        if "home_x" in df_persons.columns:
+            persons["home_coordinates"] = SharedArray.from_array(df_persons[["home_x", "home_y"]].values.astype(np.float64))
+            persons["commute_distances"] = SharedArray.from_array(df_persons["commute_distance_work"].values.astype(np.float64))
+
+        persons["offsets"] = SharedArray.from_array(persons["offsets"])
+        persons["coordinates"] = SharedArray((len(df_persons), 2), np.float64)
+
+        location_dtype = np.float64
+
+        if df_locations is None:
+            df_shapes = df_zones.drop_duplicates("zone_id").set_index("zone_id").loc[zone_ids]
+
+            for zone_id, shape in zip(zone_ids, df_shapes["geometry"]):
+                polygon_sampler.triangulate(zone_id, shape)
+
+        else:
+            df_locations = df_locations.sort_values(by = "zone_id", kind = "mergesort")
+            location_dtype = df_locations["location_id"].values.dtype
+
+            locations = {}
+            locations["offsets"] = SharedArray.from_array(get_offsets(df_locations["zone_id"].values, zone_ids))
+            locations["coordinates"] = SharedArray.from_array(df_locations[["x", "y"]].values.astype(np.float64))
+            locations["ids"] = SharedArray.from_array(df_locations["location_id"].values)
 
+        persons["ids"] = SharedArray((len(df_persons),), location_dtype)
 
-def impute_locations(df_persons, df_zones, df_locations, threads, identifier = "person_id"):
-    df_counts = df_persons[["zone_id"]].groupby("zone_id").size().reset_index(name = "count")
-    df_zones = pd.merge(df_zones, df_counts, on = "zone_id", how = "inner")
+        # Zones are handed out as contiguous ranges with similar numbers of persons
+        bounds = np.searchsorted(persons["offsets"].array[0], np.linspace(0, len(df_persons), threads + 1))
+        bounds[0], bounds[-1] = 0, len(zone_ids)
 
-    with mp.Pool(processes = threads, initializer = initialize_parallel, initargs = (df_persons, df_locations)) as pool:
-        chunks = np.array_split(df_zones[["zone_id", "count", "geometry"]].values, threads)
-        df_locations = pd.concat(pool.map(run_parallel, enumerate(chunks)))
-        df_locations = df_locations[[identifier, "x", "y", "zone_id", "location_id"]]
-        return df_locations
+        tasks = []
+
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            shapes = list(df_shapes["geometry"].values[start:end]) if df_locations is None else None
+            tasks.append((i, (start, end), shapes, ordering, random_seed, name))
+
+        with mp.Pool(processes = threads, initializer = initialize_parallel, initargs = (persons, locations)) as pool:
+            objective = np.sum(pool.map(run_parallel, tasks))
+
+        if persons["home_coordinates"] is not None:
+            print("  Ordering (%s): total commute distance deviation %.2f m, %.2f m per person" % (
+                ordering, objective, objective / max(1, len(df_persons))))
+
+        df_result = pd.DataFrame(df_persons[[identifier, "zone_id"]], copy = True)
+        df_result.loc[:, "x"] = np.array(persons["coordinates"].array[:,0])
+        df_result.loc[:, "y"] = np.array(persons["coordinates"].array[:,1])
+        df_result.loc[:, "location_id"] = np.array(persons["ids"].array)
+
+    finally:
+        for collection in (persons, locations):
+            if collection is not None:
+                for value in collection.values():
+                    if isinstance(value, SharedArray):
+                        value.unlink()
+
+    return df_result[[identifier, "x", "y", "zone_id", "location_id"]]
 
 def deg_to_rad(angle):
     return angle * np.pi / 180
 
 
-def impute_education_locations_same_zone(df_ag, hts_trips, df_candidates, df_travel, age_min, age_max, name):
-    hts_educ = hts_trips.copy()
-    hts_educ_cp = hts_educ[hts_educ["mode"]=="car_passenger"]
-    hts_educ_ncp = hts_educ[hts_educ["mode"]!="car_passenger"]
+def sample_commute_distances(hts_trips, column, count, random = np.random):
+    distribution = EmpiricalDistribution.from_histogram(hts_trips[column], hts_trips["weight"], bins = 500)
+    return distribution.sample(count, random) # in meters
 
-    dist_educ_cp = hts_educ_cp
-    hist_cp, bins_cp = np.histogram(dist_educ_cp["commute_distance_education"], weights = dist_educ_cp["weight"], bins = 500)
+def assign_facilities(df_agents, df_candidates, sampler, distances, random = np.random):
+    indices = sampler.sample(df_agents[["home_x", "home_y"]].values, distances, random)
 
-    dist_educ_ncp = hts_educ_ncp
-    hist_ncp, bins_ncp = np.histogram(dist_educ_ncp["commute_distance_education"], weights = dist_educ_ncp["weight"], bins = 500)
+    df_agents["x"] = df_candidates["x"].values[indices]
+    df_agents["y"] = df_candidates["y"].values[indices]
+    df_agents["location_id"] = df_candidates["location_id"].values[indices]
 
-    df_trips = df_travel.copy()
+    return df_agents
 
-    cp_ids = list(set(df_trips[df_trips["mode"]=="car_passenger"]["hts_person_id"].values))
+EDUCATION_CATEGORIES = {"age":[[0, 14], [15, 18], [19, 24], [25, 1000]], "gender":["male", "female"], "residence_area_index":[1,2,3]}
 
-    df_agents = df_ag.copy()
-    df_agents_cp  = df_agents[np.isin(df_agents["hts_person_id"], cp_ids)]
-    df_agents_ncp  = df_agents[np.logical_not(np.isin(df_agents["hts_person_id"], df_agents_cp["hts_person_id"]))]
+def get_education_strata(df):
+    # Returns one stratum index per row, or -1 if the row is in no stratum
+    age_bands = np.ones((len(df),), dtype = np.int64) * -1
 
-    assert len(df_agents_cp) + len(df_agents_ncp) == len(df_agents)
+    for index, (a_min, a_max) in enumerate(EDUCATION_CATEGORIES["age"]):
+        age_bands[np.logical_and(df["age"].values >= a_min, df["age"].values <= a_max)] = index
 
-    home_coordinates_cp = list(zip(df_agents_cp["home_x"], df_agents_cp["home_y"]))
-    home_coordinates_ncp = list(zip(df_agents_ncp["home_x"], df_agents_ncp["home_y"]))
-    education_coordinates = np.array(list(zip(df_candidates["x"], df_candidates["y"])))
+    sexes = pd.Index(EDUCATION_CATEGORIES["gender"]).get_indexer(df["sex"].values)
+    residence_areas = pd.Index(EDUCATION_CATEGORIES["residence_area_index"]).get_indexer(df["residence_area_index"].values)
 
-    bin_midpoints = bins_cp[:-1] + np.diff(bins_cp)/2
-    cdf = np.cumsum(hist_cp)
-    cdf = cdf / cdf[-1]
-    values = np.random.rand(len(df_agents_cp))
-    value_bins = np.searchsorted(cdf, values)
-    random_from_cdf_cp = bin_midpoints[value_bins] # in meters
-    
-    tree = KDTree(education_coordinates)
-    indices_cp, distances_cp = tree.query_radius(home_coordinates_cp, r=random_from_cdf_cp, return_distance = True, sort_results=True)
-
-    bin_midpoints = bins_ncp[:-1] + np.diff(bins_ncp)/2
-    cdf = np.cumsum(hist_ncp)
-    cdf = cdf / cdf[-1]
-    values = np.random.rand(len(df_agents_ncp))
-    value_bins = np.searchsorted(cdf, values)
-    random_from_cdf_ncp = bin_midpoints[value_bins] # in meters
-    
-    indices_ncp, distances_ncp = tree.query_radius(home_coordinates_ncp, r=random_from_cdf_ncp, return_distance = True, sort_results=True)
-
-    # In some cases no education facility was found within the given radius. In this case select the nearest facility.
-    for i in range(len(indices_cp)):
-        l = indices_cp[i] 
-        if len(l) == 0:
-            dist, ind = tree.query(np.array(home_coordinates_cp[i]).reshape(1,-1), 2, return_distance = True, sort_results=True)
-            fac = ind[0][1]
-            indices_cp[i] = [fac]
-            distances_cp[i] = [dist[0][1]]
-
-    indices_cp = [l[-1] for l in indices_cp]
-    distances_cp = [d[-1] for d in distances_cp]
-
-    for i in range(len(indices_ncp)):
-        l = indices_ncp[i] 
-        if len(l) == 0:
-            dist, ind = tree.query(np.array(home_coordinates_ncp[i]).reshape(1,-1), 2, return_distance = True, sort_results=True)
-            fac = ind[0][1]
-            indices_ncp[i] = [fac]
-            distances_ncp[i] = [dist[0][1]]
-
-    indices_ncp = [l[-1] for l in indices_ncp]
-    distances_ncp = [d[-1] for d in distances_ncp]
-
-    df_return_cp = df_agents_cp
-    df_return_cp["x"] = df_candidates.iloc[indices_cp]["x"].values
-    df_return_cp["y"] = df_candidates.iloc[indices_cp]["y"].values
-    df_return_cp["location_id"]  = df_candidates.iloc[indices_cp]["location_id"].values
-
-    df_return_ncp = df_agents_ncp
-    df_return_ncp["x"] = df_candidates.iloc[indices_ncp]["x"].values
-    df_return_ncp["y"] = df_candidates.iloc[indices_ncp]["y"].values
-    df_return_ncp["location_id"]  = df_candidates.iloc[indices_ncp]["location_id"].values
-
-    df_return = pd.concat([df_return_cp, df_return_ncp])
-    assert len(df_return) == len(df_agents)
-    return df_return
-    
-def impute_education_locations_same_zone_new(df_ag, hts_trips, df_candidates, df_travel, age_min, age_max, name):
-    hts_educ = hts_trips.copy()
-    hts_educ_cp = hts_educ[hts_educ["mode"]=="car_passenger"]
-    hts_educ_ncp = hts_educ[hts_educ["mode"]!="car_passenger"]
+    strata = (age_bands * len(EDUCATION_CATEGORIES["gender"]) + sexes) * len(EDUCATION_CATEGORIES["residence_area_index"]) + residence_areas
+    strata[(age_bands < 0) | (sexes < 0) | (residence_areas < 0)] = -1
 
-    dist_educ_cp = hts_educ
-    hist_cp, bins_cp = np.histogram(dist_educ_cp["commute_distance_education"], weights = dist_educ_cp["weight"], bins = 500)
-    
-    df_trips = df_travel.copy()
+    return strata
 
-    cp_ids = list(set(df_trips["hts_person_id"].values))
+education_sampler, education_cdfs = None, None
+def initialize_education(candidate_coordinates, cdfs):
+    global education_sampler, education_cdfs
+    education_sampler = FacilitySampler(candidate_coordinates, workers = 1)
+    education_cdfs = cdfs
 
-    df_agents = df_ag.copy()
-    df_agents_cp  = df_agents[np.isin(df_agents["hts_person_id"], cp_ids)]
+def run_education(args):
+    stratum, block, home_coordinates, random_seed = args
+    random = random_streams.get_generator(random_seed, STAGE_NAME, "education", stratum, block)
 
-    assert len(df_agents_cp) == len(df_agents)
+    distances = education_cdfs[stratum].sample(len(home_coordinates), random)
 
-    home_coordinates_cp = list(zip(df_agents_cp["home_x"], df_agents_cp["home_y"]))
-    education_coordinates = np.array(list(zip(df_candidates["x"], df_candidates["y"])))
+    return education_sampler.sample(home_coordinates, distances, random)
 
-    bin_midpoints = bins_cp[:-1] + np.diff(bins_cp)/2
-    cdf = np.cumsum(hist_cp)
-    cdf = cdf / cdf[-1]
-    values = np.random.rand(len(df_agents_cp))
-    value_bins = np.searchsorted(cdf, values)
-    random_from_cdf_cp = bin_midpoints[value_bins] # in meters
-    
-    tree = KDTree(education_coordinates)
-    indices_cp, distances_cp = tree.query_radius(home_coordinates_cp, r=random_from_cdf_cp, return_distance = True, sort_results=True)
-
-    # In some cases no education facility was found within the given radius. In this case select the nearest facility.
-    for i in range(len(indices_cp)):
-        l = indices_cp[i] 
-        if len(l) == 0:
-            dist, ind = tree.query(np.array(home_coordinates_cp[i]).reshape(1,-1), 2, return_distance = True, sort_results=True)
-            fac = ind[0][1]
-            indices_cp[i] = [fac]
-            distances_cp[i] = [dist[0][1]]
-
-    indices_cp = [l[-1] for l in indices_cp]
-    distances_cp = [d[-1] for d in distances_cp]
-
-    df_return_cp = df_agents_cp
-    df_return_cp["x"] = df_candidates.iloc[indices_cp]["x"].values
-    df_return_cp["y"] = df_candidates.iloc[indices_cp]["y"].values
-    df_return_cp["location_id"]  = df_candidates.iloc[indices_cp]["location_id"].values
-
-    df_return = df_return_cp
-    assert len(df_return) == len(df_agents)
-    return df_return    
-
-def parallelize_dataframe(hts_trips, df_ag, df_candidates, df_travel, age_min, age_max, name, func, n_cores=24):
-    df_split = np.array_split(df_ag, n_cores)
-    print("parallelize")
-    pool = mp.Pool(n_cores)
-    prod_x = partial(func, hts_trips = hts_trips, df_candidates = df_candidates, df_travel = df_travel, age_min = age_min, age_max = age_max, name=name)
-    df_locations = pd.concat(pool.map(prod_x, df_split))
-    pool.close()
-    pool.join()
-    return df_locations
-    
+def impute_education_locations_stratified(df_agents, hts_trips, df_candidates, df_travel, threads, random_seed = None):
+    df_agents = df_agents.copy()
+    df_agents["stratum"] = get_education_strata(df_agents)
+    df_agents = df_agents[df_agents["stratum"] >= 0]
 
-def impute_work_locations_same_zone(hts_trips, df_ag, df_candidates, df_travel, name):
-    hts_work = hts_trips.copy()
+    hts_trips = hts_trips.copy()
+    hts_trips["stratum"] = get_education_strata(hts_trips)
+
+    # All agents need synthetic trips in the same stratum
+    travel_keys = pd.MultiIndex.from_arrays([get_education_strata(df_travel), df_travel["hts_person_id"].values])
+    assert pd.MultiIndex.from_arrays([df_agents["stratum"].values, df_agents["hts_person_id"].values]).isin(travel_keys).all()
 
-    hist_cp, bins_cp = np.histogram(hts_work["crowfly_distance"], weights = hts_work["weight"], bins = 500)
+    # Commute distance distributions for all strata up front
+    cdfs = {}
 
-    df_trips = df_travel.copy()
+    for stratum, df_stratum in hts_trips[hts_trips["stratum"] >= 0].groupby("stratum"):
+        cdfs[stratum] = EmpiricalDistribution.from_histogram(df_stratum["commute_distance_education"], df_stratum["weight"], bins = 500)
+
+    # Strata are split into blocks of agents with their own random streams,
+    # which are processed as tasks by one pool
+    tasks, task_indices = [], []
+    home_coordinates = df_agents[["home_x", "home_y"]].values
+
+    for stratum, indices in df_agents.groupby("stratum").indices.items():
+        if not stratum in cdfs:
+            raise RuntimeError("No HTS education trips for stratum %d" % stratum)
+
+        for block, (start, end) in enumerate(random_streams.get_blocks(len(indices))):
+            tasks.append((stratum, block, home_coordinates[indices[start:end]], random_seed))
+            task_indices.append(indices[start:end])
+
+    with mp.Pool(processes = threads, initializer = initialize_education, initargs = (df_candidates[["x", "y"]].values, cdfs)) as pool:
+        results = pool.map(run_education, tasks)
+
+    locations = np.zeros((len(df_agents),), dtype = np.int64)
+
+    for chunk, result in zip(task_indices, results):
+        locations[chunk] = result
+
+    df_agents["x"] = df_candidates["x"].values[locations]
+    df_agents["y"] = df_candidates["y"].values[locations]
+    df_agents["location_id"] = df_candidates["location_id"].values[locations]
+
+    return df_agents
+
+def impute_work_locations_same_zone(hts_trips, df_ag, df_candidates, df_travel, name, sampler, random = np.random):
+    hts_work = hts_trips.copy()
 
     df_agents = df_ag.copy()
     df_agents_cp  = df_agents#[np.isin(df_agents["hts_person_id"], cp_ids)]
 
-    home_coordinates_cp = list(zip(df_agents_cp["home_x"], df_agents_cp["home_y"]))
-    work_coordinates = np.array(list(zip(df_candidates["x"], df_candidates["y"])))
+    random_from_cdf_cp = sample_commute_distances(hts_work, "crowfly_distance", len(df_agents_cp), random)
 
-    bin_midpoints = bins_cp[:-1] + np.diff(bins_cp)/2
-    cdf = np.cumsum(hist_cp)
-    cdf = cdf / cdf[-1]
-    values = np.random.rand(len(df_agents_cp))
-    value_bins = np.searchsorted(cdf, values)
-    random_from_cdf_cp = bin_midpoints[value_bins] # in meters
-    
-    tree = KDTree(work_coordinates)
-    indices_cp, distances_cp = tree.query_radius(home_coordinates_cp, r=random_from_cdf_cp, return_distance = True, sort_results=True)
-
-    
-    # In some cases no work facility was found within the given radius. In this case select the nearest facility.
-    for i in range(len(indices_cp)):
-        l = indices_cp[i] 
-        if len(l) == 0:
-            dist, ind = tree.query(np.array(home_coordinates_cp[i]).reshape(1,-1), 2, return_distance = True, sort_results=True)
-            fac = ind[0][1]
-            indices_cp[i] = [fac]
-            distances_cp[i] = [dist[0][1]]
-
-    indices_cp = [l[-1] for l in indices_cp]
-    distances_cp = [d[-1] for d in distances_cp]    
-
-    df_return_cp = df_agents_cp.copy()
-    df_return_cp["x"] = df_candidates.iloc[indices_cp]["x"].values
-    df_return_cp["y"] = df_candidates.iloc[indices_cp]["y"].values
-    df_return_cp["location_id"]  = df_candidates.iloc[indices_cp]["location_id"].values
-    
-    df_return = df_return_cp
+    df_return = assign_facilities(df_agents_cp.copy(), df_candidates, sampler, random_from_cdf_cp, random)
     assert len(df_return) == len(df_agents)
     return df_return
 
 
 def execute(context):
     threads = context.config("processes")
+    random_seed = context.config("random_seed")
     df_zones = context.stage("data.spatial.zones")[["zone_id", "geometry"]]
     df_commune_zones = context.stage("data.spatial.zones")
     df_zones["zone_id"] = df_zones["zone_id"].astype(np.int)
@@ -332,7 +370,7 @@ def execute(context):
     df_hhl.rename(columns={"household_id":"person_id"}, inplace = True)
     df_home_opportunities = df_opportunities[df_opportunities["offers_home"]]
 
-    df_home = impute_locations(df_hhl, df_zones, df_home_opportunities, threads, "person_id")[["person_id", "x", "y", "location_id"]]
+    df_home = impute_locations(df_hhl, df_zones, df_home_opportunities, threads, "person_id", random_seed = random_seed, name = "home")[["person_id", "x", "y", "location_id"]]
     df_home.rename(columns = {"person_id":"household_id"}, inplace = True)
     df_hhl = context.stage("synthesis.population.sampled")
     df_home = pd.merge(df_hhl, df_home, on = ["household_id"], how = "left")
@@ -354,7 +392,7 @@ def execute(context):
 
     df_work_locations = df_opportunities[df_opportunities["offers_work"]]
 
-    df_work = impute_locations(df_work_different_zone, df_zones, df_work_locations, 24)[["person_id", "x", "y", "location_id"]]
+    df_work = impute_locations(df_work_different_zone, df_zones, df_work_locations, threads, ordering = context.config("work_ordering"), random_seed = random_seed, name = "work")[["person_id", "x", "y", "location_id"]]
     
     print("Imputing same zone work locations ...")
     df_work_same_zone = df_work_zones.copy()
@@ -373,7 +411,9 @@ def execute(context):
     df_agents = df_work_same_zone.copy()
     df_trips = context.stage("synthesis.population.trips")
 
-    work_locations = impute_work_locations_same_zone(hts_trips_work, df_agents, df_candidates, df_trips, "/home/asallard/Scenarios/work.png")
+    work_sampler = FacilitySampler(df_candidates[["x", "y"]].values)
+    work_locations = impute_work_locations_same_zone(hts_trips_work, df_agents, df_candidates, df_trips, "/home/asallard/Scenarios/work.png", work_sampler,
+        random_streams.get_generator(random_seed, STAGE_NAME, "work_same_zone"))
     df_work_same_zone = work_locations[["person_id", "x", "y", "location_id"]]    
 
     df_work = df_work.append(df_work_same_zone, sort = False)        
@@ -402,32 +442,7 @@ def execute(context):
     df_agents = df_persons_same_zone.copy()
     df_trips = context.stage("synthesis.population.trips")
 
-    categories = {"age":[[0, 14], [15, 18], [19, 24], [25, 1000]], "gender":["male", "female"], "residence_area_index":[1,2,3]}
-    dflist_educ = []
-    for a_cat in categories["age"]:
-        for sex_cat in categories["gender"]:
-            for res_cat in categories["residence_area_index"]:
-                a_min = a_cat[0]
-                a_max = a_cat[1]
-
-                df_travel = df_trips.copy()
-                df_travel = df_travel[np.logical_and(df_travel["age"] >= a_min, df_travel["age"] <= a_max)]
-                df_travel = df_travel[df_travel["sex"] == sex_cat]
-                df_travel = df_travel[df_travel["residence_area_index"] == res_cat]
-
-                df_ag = df_agents.copy()
-                df_ag = df_ag[np.logical_and(df_ag["age"] >= a_min, df_ag["age"] <= a_max)]
-                df_ag = df_ag[df_ag["sex"] == sex_cat]
-                df_ag = df_ag[df_ag["residence_area_index"] == res_cat] 
-
-                hts_trips = hts_trips_educ[np.logical_and(hts_trips_educ["age"] >= a_min, hts_trips_educ["age"] <= a_max)]
-                hts_trips = hts_trips[hts_trips["sex"] == sex_cat]
-                hts_trips = hts_trips[hts_trips["residence_area_index"] == res_cat]
-
-                educ_current = parallelize_dataframe(hts_trips, df_ag, df_candidates, df_travel, a_min,  a_max, "/home/asallard/Scenarios/educ014.png", impute_education_locations_same_zone_new, 3)
-                dflist_educ.append(educ_current)
-
-    education_locations = pd.concat(dflist_educ)
+    education_locations = impute_education_locations_stratified(df_agents, hts_trips_educ, df_candidates, df_trips, threads, random_seed)
     df_persons_same_zone = education_locations[["person_id", "x", "y", "location_id"]]
 
     df_education = df_persons_same_zone    
@@ -1,6 +1,7 @@
 import synthesis.population.spatial.by_person.secondary.rda as rda
-import sklearn.neighbors
 import numpy as np
+from scipy.spatial import cKDTree
+from synthesis.population.algo.facility_sampling import query
 
 class CustomDistanceSampler(rda.FeasibleDistanceSampler):
     def __init__(self, random, distributions, maximum_iterations = 1000):
@@ -10,39 +11,82 @@ class CustomDistanceSampler(rda.FeasibleDistanceSampler):
         self.distributions = distributions
 
     def sample_distances(self, problem):
-        distances = np.zeros((problem["size"] + 1))
+        return self.sample_distances_batch([problem], 1)[0][0]
 
-        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
-            mode_distribution = self.distributions[mode]
+    def sample_distances_batch(self, problems, count):
+        # Draws the candidate distances of all problems with one call per mode,
+        # the trips of each problem are repeated for every candidate
+        if len(problems) == 0:
+            return []
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+        trips = np.array([len(problem["modes"]) for problem in problems])
+        offsets = np.cumsum(np.append(0, trips * count))
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
-            ]
+        modes = np.hstack([np.tile(np.asarray(problem["modes"]), count) for problem in problems])
+        travel_times = np.hstack([np.tile(np.asarray(problem["travel_times"], dtype = np.float64), count) for problem in problems])
 
-        return distances
+        sampled_distances = np.zeros((len(modes),))
+
+        for mode in np.unique(modes):
+            f = modes == mode
+            sampled_distances[f] = self.distributions[mode].sample(travel_times[f], self.random)
+
+        results = []
+
+        for problem, problem_trips, start, end in zip(problems, trips, offsets[:-1], offsets[1:]):
+            distances = np.zeros((count, problem["size"] + 1))
+            distances[:, :problem_trips] = sampled_distances[start:end].reshape((count, problem_trips))
+            results.append(distances)
+
+        return results
 
 class CustomDiscretizationSolver(rda.DiscretizationSolver):
-    def __init__(self, data):
+    def __init__(self, data, workers = -1):
         self.data = data
+        self.workers = workers
         self.indices = {}
 
         for purpose, data in self.data.items():
             print("Constructing spatial index for %s ..." % purpose)
-            self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
+            self.indices[purpose] = cKDTree(data["locations"])
+
+        self.identifier_dtype = np.result_type(*[data["identifiers"] for data in self.data.values()])
+
+    def discretize(self, purposes, locations):
+        # Finds the closest destination for many locations at once, with one
+        # query per purpose
+        purposes = np.asarray(purposes)
+        locations = np.asarray(locations, dtype = np.float64).reshape((-1, 2))
+
+        discretized_identifiers = np.zeros((len(purposes),), dtype = self.identifier_dtype)
+        discretized_locations = np.zeros((len(purposes), 2))
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            _, indices = query(self.indices[purpose], locations[f], 1, self.workers)
+
+            discretized_identifiers[f] = self.data[purpose]["identifiers"][indices]
+            discretized_locations[f] = self.data[purpose]["locations"][indices]
+
+        return discretized_identifiers, discretized_locations
 
     def solve(self, problem, locations):
-        discretized_locations = []
-        discretized_identifiers = []
+        return self.solve_batch([problem], [locations])[0]
 
-        for location, purpose in zip(locations, problem["purposes"]):
-            index = self.indices[purpose].query(location.reshape(1, -1), return_distance = False)[0][0]
+    def solve_batch(self, problems, locations):
+        # Discretizes the relaxed locations of many problems in one pass
+        if len(problems) == 0:
+            return []
 
-            discretized_identifiers.append(self.data[purpose]["identifiers"][index])
-            discretized_locations.append(self.data[purpose]["locations"][index])
+        sizes = [problem["size"] for problem in problems]
+        offsets = np.cumsum([0] + sizes)
 
-        return dict(
-            valid = True, locations = np.vstack(discretized_locations), identifiers = discretized_identifiers
+        identifiers, discretized_locations = self.discretize(
+            np.hstack([problem["purposes"] for problem in problems]),
+            np.vstack(locations)
         )
+
+        return [
+            dict(valid = True, locations = discretized_locations[start:end], identifiers = identifiers[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
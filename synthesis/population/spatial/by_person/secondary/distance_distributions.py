@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from synthesis.population.algo.distributions import ConditionalDistributionTable
 
 def configure(context):
     context.stage("data.hts.cleaned")
@@ -50,28 +51,12 @@ def execute(context):
     distributions = {}
 
     for mode in modes:
-        # First calculate bounds by unique values
-        f_mode = df["mode"] == mode
-        bounds = calculate_bounds(df[f_mode]["travel_time"].values, bin_size)
+        # First calculate bounds by unique values, then the distribution of
+        # distances per travel time band
+        df_mode = df[df["mode"] == mode]
+        bounds = calculate_bounds(df_mode["travel_time"].values, bin_size)
 
-        distributions[mode] = dict(bounds = np.array(bounds), distributions = [])
-
-        # Second, calculate distribution per band
-        for lower_bound, upper_bound in zip([-np.inf] + bounds[:-1], bounds):
-            f_bound = (df["travel_time"] > lower_bound) & (df["travel_time"] <= upper_bound)
-
-            # Set up distribution
-            values = df[f_mode & f_bound]["distance"].values
-            weights = df[f_mode & f_bound]["weight"].values
-
-            sorter = np.argsort(values)
-            values = values[sorter]
-            weights = weights[sorter]
-
-            cdf = np.cumsum(weights)
-            cdf /= cdf[-1]
-
-            # Write distribution
-            distributions[mode]["distributions"].append(dict(cdf = cdf, values = values, weights = weights))
+        distributions[mode] = ConditionalDistributionTable.from_samples(
+            df_mode["travel_time"].values, df_mode["distance"].values, df_mode["weight"].values, bounds)
 
     return distributions
@@ -1,10 +1,9 @@
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
-import shapely.geometry as geo
-import geopandas as gpd
 import time
-from synthesis.population.spatial.by_person.secondary.problems import find_assignment_problems
+from synthesis.population.spatial.by_person.secondary.problems import find_assignment_problems, LOCATION_FIELDS
+import synthesis.population.algo.random_streams as random_streams
 
 def configure(context):
     context.stage("synthesis.population.trips")
@@ -22,25 +21,24 @@ def prepare_locations(context):
     # Load persons and their primary locations
     df_home, df_work, df_education = context.stage("synthesis.population.spatial.by_person.primary_locations")
 
-    df_home["home"] = [geo.Point(px,py) for px, py in list(zip(df_home["x"].values.tolist(), df_home["y"].values.tolist()))]
-
-    df_work["work"] = [geo.Point(px,py) for px, py in list(zip(df_work["x"].values.tolist(), df_work["y"].values.tolist()))]
-
-    df_education["education"] = [geo.Point(px,py) for px, py in list(zip(df_education["x"].values.tolist(), df_education["y"].values.tolist()))]
+    # Coordinates are passed on as plain float columns
+    for df, purpose in ((df_home, "home"), (df_work, "work"), (df_education, "education")):
+        df["%s_x" % purpose] = df["x"].astype(np.float64)
+        df["%s_y" % purpose] = df["y"].astype(np.float64)
 
     df_persons = context.stage("synthesis.population.sampled")[["person_id", "household_id"]]
     df_locations = pd.merge(df_home, df_persons, how = "left", on = ["person_id", "household_id"])
-    df_locations = pd.merge(df_locations, df_work[["person_id", "work"]], how = "left", on = "person_id")
-    df_locations = pd.merge(df_locations, df_education[["person_id", "education"]], how = "left", on = "person_id")
+    df_locations = pd.merge(df_locations, df_work[["person_id", "work_x", "work_y"]], how = "left", on = "person_id")
+    df_locations = pd.merge(df_locations, df_education[["person_id", "education_x", "education_y"]], how = "left", on = "person_id")
 
-    return df_locations[["person_id", "home", "work", "education"]].sort_values(by = "person_id")
+    return df_locations[LOCATION_FIELDS].sort_values(by = "person_id")
 
 def prepare_destinations(context):
     df_destinations = context.stage("synthesis.destinations")
     df_destinations.rename(columns = {"location_id": "destination_id"}, inplace = True)
 
     identifiers = df_destinations["destination_id"].values
-    locations = np.vstack(df_destinations["geometry"].apply(lambda x: np.array([x.x, x.y])).values)
+    locations = df_destinations[["x", "y"]].values.astype(np.float64)
 
     data = {}
 
@@ -54,19 +52,9 @@ def prepare_destinations(context):
 
     return data
 
-def resample_cdf(cdf, factor):
-    if factor >= 0.0:
-        cdf = cdf * (1.0 + factor * np.arange(1, len(cdf) + 1) / len(cdf))
-    else:
-        cdf = cdf * (1.0 + abs(factor) - abs(factor) * np.arange(1, len(cdf) + 1) / len(cdf))
-
-    cdf /= cdf[-1]
-    return cdf
-
 def resample_distributions(distributions, factors):
-    for mode, mode_distributions in distributions.items():
-        for distribution in mode_distributions["distributions"]:
-            distribution["cdf"] = resample_cdf(distribution["cdf"], factors[mode])
+    for mode in distributions.keys():
+        distributions[mode] = distributions[mode].resample(factors[mode])
 
 from synthesis.population.spatial.by_person.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver
 from synthesis.population.spatial.by_person.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver
@@ -93,19 +81,26 @@ def execute(context):
 
     unique_person_ids = df_trips["person_id"].unique()
     number_of_persons = len(unique_person_ids)
-    unique_person_ids = np.array_split(unique_person_ids, processes)
 
-    random = np.random.RandomState(context.config("random_seed"))
-    random_seeds = random.randint(10000, size = processes)
+    # Create batch problems for parallelization. Batches are fixed blocks of
+    # persons with their own random streams, keyed by the block index, so the
+    # result does not depend on the number of processes. The blocks are small
+    # such that the processes are kept busy also for small samples.
+    blocks = random_streams.get_blocks(number_of_persons, random_streams.SMALL_BLOCK_SIZE)
+
+    # Trips and primary locations are sorted by person, so the blocks are
+    # sliced from them by offsets
+    boundary_person_ids = unique_person_ids[[start for start, end in blocks]]
+    trip_offsets = np.append(np.searchsorted(df_trips["person_id"].values, boundary_person_ids), len(df_trips))
+    primary_offsets = np.append(np.searchsorted(df_primary["person_id"].values, boundary_person_ids), len(df_primary))
 
-    # Create batch problems for parallelization
     batches = []
 
-    for index in range(processes):
+    for index in range(len(blocks)):
         batches.append((
-            df_trips[df_trips["person_id"].isin(unique_person_ids[index])],
-            df_primary[df_primary["person_id"].isin(unique_person_ids[index])],
-            random_seeds[index]
+            df_trips.iloc[trip_offsets[index]:trip_offsets[index + 1]],
+            df_primary.iloc[primary_offsets[index]:primary_offsets[index + 1]],
+            index
         ))
 
     # Run algorithm in parallel
@@ -127,12 +122,27 @@ def execute(context):
 
     return df_locations, df_convergence
 
+# Number of assignment problems that are solved together
+BATCH_SIZE = 1000
+
+# The spatial indices of the destinations are built once per worker process
+# and reused for all blocks that it processes. Queries are single-threaded
+# because the blocks already run in parallel processes.
+cached_discretization_solver = None
+
+def get_discretization_solver(destinations):
+  global cached_discretization_solver
+
+  if cached_discretization_solver is None or not cached_discretization_solver.data is destinations:
+      cached_discretization_solver = CustomDiscretizationSolver(destinations, workers = 1)
+
+  return cached_discretization_solver
+
 def process(context, arguments):
-  df_trips, df_primary, random_seed = arguments
-    
+  df_trips, df_primary, block = arguments
 
   # Set up RNG
-  random = np.random.RandomState(context.config("random_seed"))
+  random = random_streams.get_random_state(context.config("random_seed"), "synthesis.population.spatial.by_person.secondary.locations", block)
 
   # Set up distance sampler
   distance_distributions = context.data("distance_distributions")
@@ -147,8 +157,7 @@ def process(context, arguments):
     )
 
   # Set up discretization solver
-  destinations = context.data("destinations")
-  discretization_solver = CustomDiscretizationSolver(destinations)
+  discretization_solver = get_discretization_solver(context.data("destinations"))
 
   # Set up assignment solver
   thresholds = dict(
@@ -168,28 +177,41 @@ def process(context, arguments):
   df_locations = []
   df_convergence = []
 
+  # Problems are solved in batches, such that all chains of a batch are
+  # relaxed and discretized together
+  problems = find_assignment_problems(df_trips, df_primary)
   last_person_id = None
 
-  for problem in find_assignment_problems(df_trips, df_primary):    
-      result = assignment_solver.solve(problem)
+  for start in range(0, len(problems), BATCH_SIZE):
+      batch_problems = [problems[index] for index in range(start, min(start + BATCH_SIZE, len(problems)))]
 
-      starting_trip_index = problem["trip_index"]
-
-      for index, (identifier, location) in enumerate(zip(result["discretization"]["identifiers"], result["discretization"]["locations"])):
+      for problem, result in zip(batch_problems, assignment_solver.solve_batch(batch_problems)):
           df_locations.append((
-              problem["person_id"], starting_trip_index + index, identifier, geo.Point(location)
+              np.repeat(problem["person_id"], problem["size"]),
+              problem["trip_index"] + np.arange(problem["size"]),
+              result["discretization"]["identifiers"],
+              result["discretization"]["locations"]
           ))
 
-      df_convergence.append((
-          result["valid"], problem["size"]
-      ))
-
-      if problem["person_id"] != last_person_id:
-          last_person_id = problem["person_id"]
-          context.progress.update()
+          df_convergence.append((
+              result["valid"], problem["size"]
+          ))
 
-  df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "trip_index", "destination_id", "geometry"])
-  df_locations = gpd.GeoDataFrame(df_locations, crs = dict(init = "epsg:29183"))
+          if problem["person_id"] != last_person_id:
+              last_person_id = problem["person_id"]
+              context.progress.update()
+
+  # Locations are returned as plain coordinates, geometries are only created
+  # for the final output
+  if len(df_locations) > 0:
+      person_ids, trip_indices, identifiers, locations = [np.concatenate(values) for values in zip(*df_locations)]
+  else:
+      person_ids, trip_indices, identifiers, locations = [], [], [], np.zeros((0, 2))
+
+  df_locations = pd.DataFrame(dict(
+      person_id = person_ids, trip_index = trip_indices, destination_id = identifiers,
+      x = locations[:,0], y = locations[:,1]
+  ), columns = ["person_id", "trip_index", "destination_id", "x", "y"])
 
   df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
   return df_locations, df_convergence
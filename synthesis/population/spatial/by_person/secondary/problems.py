@@ -4,88 +4,153 @@ import pandas as pd
 FIELDS = ["person_id", "trip_id", "preceeding_purpose", "following_purpose", "mode", "travel_time"]
 FIXED_PURPOSES = ["home", "work", "education"]
 
-def find_bare_assignment_problems(df):
-    problem = None
+def get_codes(values):
+    categories, codes = np.unique(values, return_inverse = True)
+    return categories, codes.astype(np.int8 if len(categories) <= np.iinfo(np.int8).max else np.int32)
 
-    for row in df[FIELDS].itertuples(index = False):
-        person_id, trip_index, preceeding_purpose, following_purpose, mode, travel_time = row
+class AssignmentProblems:
+    """
+        Columnar table of assignment problems. Problem i has the variable
+        activities purposes[purpose_offsets[i]:purpose_offsets[i + 1]] and the
+        trips modes / travel_times[trip_offsets[i]:trip_offsets[i + 1]].
+        Purposes and modes are stored as codes into the category arrays.
+        Origins and destinations are NaN if the chain has no fixed activity
+        at that end (tails).
+    """
+    def __init__(self, person_ids, trip_indices, sizes, origins, destinations,
+        purpose_offsets, purposes, purpose_categories,
+        trip_offsets, modes, mode_categories, travel_times):
+
+        self.person_ids = person_ids
+        self.trip_indices = trip_indices
+        self.sizes = sizes
+        self.origins = origins
+        self.destinations = destinations
+        self.purpose_offsets = purpose_offsets
+        self.purposes = purposes
+        self.purpose_categories = purpose_categories
+        self.trip_offsets = trip_offsets
+        self.modes = modes
+        self.mode_categories = mode_categories
+        self.travel_times = travel_times
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    def __getitem__(self, index):
+        # Problem view in the format that is expected by the solvers
+        purpose_start, purpose_end = self.purpose_offsets[index], self.purpose_offsets[index + 1]
+        trip_start, trip_end = self.trip_offsets[index], self.trip_offsets[index + 1]
+
+        origin, destination = self.origins[index:index + 1], self.destinations[index:index + 1]
+
+        return dict(
+            person_id = self.person_ids[index], trip_index = self.trip_indices[index], size = self.sizes[index],
+            purposes = self.purpose_categories[self.purposes[purpose_start:purpose_end]],
+            modes = self.mode_categories[self.modes[trip_start:trip_end]],
+            travel_times = self.travel_times[trip_start:trip_end],
+            origin = None if np.isnan(origin[0, 0]) else origin,
+            destination = None if np.isnan(destination[0, 0]) else destination
+        )
+
+LOCATION_FIELDS = ["person_id", "home_x", "home_y", "work_x", "work_y", "education_x", "education_y"]
 
-        if not problem is None and person_id != problem["person_id"]:
-            # We switch person, but we're still tracking a problem. This is a tail!
-            yield problem
-            problem = None
+def find_assignment_problems(df, df_locations):
+    """
+        Segments the trips, sorted by person and trip, into assignment problems:
+          - A problem ends with a trip towards a fixed activity or with the last trip of a person
+          - Locations of the fixed activities are attached
+          - Purposes are reduced to the variable ones
+          - Problems without variable activities are skipped
+    """
+    person_ids = df["person_id"].values
+    trip_ids = df["trip_id"].values
+    # Purposes and modes are categorical in the trip data
+    preceeding_purposes = np.asarray(df["preceeding_purpose"].astype(str), dtype = object)
+    following_purposes = np.asarray(df["following_purpose"].astype(str), dtype = object)
+    modes = np.asarray(df["mode"].astype(str), dtype = object)
 
-        if problem is None:
-            # Start a new problem
-            problem = dict(
-                person_id = person_id, trip_index = trip_index, purposes = [preceeding_purpose],
-                modes = [], travel_times = []
-            )
+    first_trip = np.ones((len(df),), dtype = np.bool)
+    first_trip[1:] = person_ids[1:] != person_ids[:-1]
 
-        problem["purposes"].append(following_purpose)
-        problem["modes"].append(mode)
-        problem["travel_times"].append(travel_time)
+    last_trip = np.ones((len(df),), dtype = np.bool)
+    last_trip[:-1] = person_ids[:-1] != person_ids[1:]
 
-        if problem["purposes"][-1] in FIXED_PURPOSES:
-            # The current chain (or initial tail) ends with a fixed
-            yield problem
-            problem = None
+    following_fixed = np.isin(following_purposes, FIXED_PURPOSES)
 
- 
+    # A problem starts with the first trip of a person or after a fixed activity
+    problem_start = first_trip.copy()
+    problem_start[1:] |= following_fixed[:-1]
+    problem_end = following_fixed | last_trip
 
-LOCATION_FIELDS = ["person_id", "home", "work", "education"]
+    problem_index = np.cumsum(problem_start) - 1
+    starts, ends = np.where(problem_start)[0], np.where(problem_end)[0]
+    trip_counts = ends - starts + 1
 
-def find_assignment_problems(df, df_locations):
-    """
-        Enriches assignment problems with:
-          - Locations of the fixed activities
-          - Size of the problem
-          - Reduces purposes to the variable ones
-    """
-    location_iterator = df_locations[LOCATION_FIELDS].itertuples(index = False)
-    current_location = None    
+    origin_purposes = preceeding_purposes[starts]
+    destination_purposes = following_purposes[ends]
+
+    origin_fixed = np.isin(origin_purposes, FIXED_PURPOSES)
+    destination_fixed = np.isin(destination_purposes, FIXED_PURPOSES)
 
-    for problem in find_bare_assignment_problems(df):
-        origin_purpose = problem["purposes"][0]
-        destination_purpose = problem["purposes"][-1]
-        pi = problem["purposes"]
+    if np.any(~origin_fixed & ~destination_fixed):
+        raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
 
-        # Reduce purposes
-        if origin_purpose in FIXED_PURPOSES and destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:-1]
+    sizes = trip_counts - (origin_fixed & destination_fixed)
 
-        elif origin_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:]
+    # The activity before each trip is the preceeding purpose for the first
+    # trip of a problem and the previous following purpose otherwise. Every
+    # problem additionally has the activity after its last trip.
+    activities = np.empty((len(df) + len(starts),), dtype = following_purposes.dtype)
+    activity_variable = np.ones((len(activities),), dtype = np.bool)
 
-        elif destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][:-1]
+    trip_activities = np.arange(len(df)) + problem_index
+    activities[trip_activities[1:]] = following_purposes[:-1]
+    activities[trip_activities[starts]] = origin_purposes
+    activity_variable[trip_activities[starts]] = ~origin_fixed
 
-        else:
-            raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
+    final_activities = ends + np.arange(len(starts)) + 1
+    activities[final_activities] = destination_purposes
+    activity_variable[final_activities] = ~destination_fixed
 
-        # Define size
-        problem["size"] = len(problem["purposes"])
+    # Problems without variable activities are skipped
+    f_problem = sizes > 0
+    f_trip = f_problem[problem_index]
+    f_activity = activity_variable & np.repeat(f_problem, trip_counts + 1)
 
-        if problem["size"] == 0:
-            continue # We can skip if there are no variable activities
+    purpose_categories, purposes = get_codes(activities[f_activity])
+    mode_categories, modes = get_codes(modes[f_trip])
 
-        # Advance location iterator until we arrive at the current problem's person
-        while current_location is None or current_location[0] != problem["person_id"]:
-            current_location = next(location_iterator)
+    sizes, trip_counts = sizes[f_problem], trip_counts[f_problem]
+    starts = starts[f_problem]
+    origin_purposes, destination_purposes = origin_purposes[f_problem], destination_purposes[f_problem]
+    origin_fixed, destination_fixed = origin_fixed[f_problem], destination_fixed[f_problem]
 
-        # Define origin and destination locations if they have fixed purposes
-        problem["origin"] = None
-        problem["destination"] = None
+    # Attach the locations of the fixed activities
+    df_locations = df_locations[LOCATION_FIELDS]
+    location_indices = pd.Index(df_locations["person_id"].values).get_indexer(person_ids[starts])
 
-        if origin_purpose in FIXED_PURPOSES:
-            problem["origin"] = current_location[LOCATION_FIELDS.index(origin_purpose)] # Shapely POINT
-            problem["origin"] = np.array([[problem["origin"].x, problem["origin"].y]])
+    if np.any(location_indices < 0):
+        raise RuntimeError("Locations are missing for some persons")
 
-        if destination_purpose in FIXED_PURPOSES:
-            problem["destination"] = current_location[LOCATION_FIELDS.index(destination_purpose)] # Shapely POINT
-            problem["destination"] = np.array([[problem["destination"].x, problem["destination"].y]])
+    coordinates = np.stack([
+        df_locations[["%s_x" % purpose, "%s_y" % purpose]].values.astype(np.float64)
+        for purpose in FIXED_PURPOSES
+    ], axis = 1)
 
-        yield problem
+    origins = np.ones((len(starts), 2)) * np.nan
+    origins[origin_fixed] = coordinates[
+        location_indices[origin_fixed], pd.Index(FIXED_PURPOSES).get_indexer(origin_purposes[origin_fixed])]
 
+    destinations = np.ones((len(starts), 2)) * np.nan
+    destinations[destination_fixed] = coordinates[
+        location_indices[destination_fixed], pd.Index(FIXED_PURPOSES).get_indexer(destination_purposes[destination_fixed])]
 
+    if np.any(np.isnan(origins[origin_fixed])) or np.any(np.isnan(destinations[destination_fixed])):
+        raise RuntimeError("Locations are missing for some fixed activities")
 
+    return AssignmentProblems(
+        person_ids[starts], trip_ids[starts], sizes, origins, destinations,
+        np.append(0, np.cumsum(sizes)), purposes, purpose_categories,
+        np.append(0, np.cumsum(trip_counts)), modes, mode_categories, df["travel_time"].values[f_trip].astype(np.float64)
+    )
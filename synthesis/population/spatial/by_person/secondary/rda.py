@@ -16,18 +16,38 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibility_batch(distances, direct_distances, consider_total_distance = True):
+    # Same as calculate_feasibility for many distance chains at once, the
+    # chains are given along the last axis of distances
+    total_distances = np.sum(distances, axis = -1)
+    delta = np.max(2.0 * distances, axis = -1) - total_distances - direct_distances
+
+    if consider_total_distance:
+        delta = np.maximum(delta, direct_distances - total_distances)
+
+    return np.maximum(delta, 0.0)
+
 class DiscretizationSolver:
     def solve(self, problem, locations):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, locations):
+        return [self.solve(problem, problem_locations) for problem, problem_locations in zip(problems, locations)]
+
 class RelaxationSolver:
     def solve(self, problem, distances):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, distances):
+        return [self.solve(problem, problem_distances) for problem, problem_distances in zip(problems, distances)]
+
 class DistanceSampler:
     def sample(self, problem):
         raise NotImplementedError()
 
+    def sample_batch(self, problems):
+        return [self.sample(problem) for problem in problems]
+
 class AssignmentObjective:
     def evaluate(self, problem, distance_result, relaxation_result, discretization_result):
         raise NotImplementedError()
@@ -65,6 +85,48 @@ class AssignmentSolver:
 
         return best_result
 
+    def solve_batch(self, problems):
+        # Runs the iterations for many problems at once, such that the
+        # relaxation and discretization solvers can work on whole batches
+        best_results = [None] * len(problems)
+        active = list(range(len(problems)))
+
+        for assignment_iteration in range(self.maximum_iterations):
+            if len(active) == 0:
+                break
+
+            active_problems = [problems[index] for index in active]
+
+            distance_results = self.distance_sampler.sample_batch(active_problems)
+
+            relaxation_results = self.relaxation_solver.solve_batch(
+                active_problems, [result["distances"] for result in distance_results])
+
+            discretization_results = self.discretization_solver.solve_batch(
+                active_problems, [result["locations"] for result in relaxation_results])
+
+            remaining = []
+
+            for index, problem, distance_result, relaxation_result, discretization_result in zip(
+                active, active_problems, distance_results, relaxation_results, discretization_results):
+
+                assignment_result = self.objective.evaluate(problem, distance_result, relaxation_result, discretization_result)
+
+                if best_results[index] is None or assignment_result["objective"] < best_results[index]["objective"]:
+                    best_results[index] = assignment_result
+
+                    assignment_result["distance"] = distance_result
+                    assignment_result["relaxation"] = relaxation_result
+                    assignment_result["discretization"] = discretization_result
+                    assignment_result["iterations"] = assignment_iteration
+
+                if not best_results[index]["valid"]:
+                    remaining.append(index)
+
+            active = remaining
+
+        return best_results
+
 class ChainTailRelaxationSolver(RelaxationSolver):
     def __init__(self, chain_solver, tail_solver):
         self.chain_solver = chain_solver
@@ -111,7 +173,7 @@ class AngularTailSolver(RelaxationSolver):
 
         return dict(valid = True, locations = locations)
 
-class GravityChainSolver:
+class GravityChainSolver(RelaxationSolver):
     def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None):
         self.alpha = 0.3
         self.eps = 1e-2
@@ -119,143 +181,200 @@ class GravityChainSolver:
         self.random = random
         self.lateral_deviation = lateral_deviation
 
-    def solve_two_points(self, problem, origin, destination, distances, direction, direct_distance):
-        if direct_distance == 0.0:
-            location = origin + direction * distances[0]
+    def solve(self, problem, distances):
+        return self.solve_batch([problem], [distances])[0]
 
-            return dict(
-                valid = distances[0] == distances[1],
-                locations = location.reshape(-1, 2), iterations = None
-            )
+    def solve_batch(self, problems, distances):
+        """
+            Solves many chains at once. The random numbers are drawn chain by
+            chain in the same order as when solving the chains one after
+            another, then the chains with one variable point are solved in
+            closed form and all other chains are relaxed together, grouped
+            by their size.
+        """
+        results = [None] * len(problems)
 
-        elif direct_distance > np.sum(distances):
-            ratio = 1.0
+        two_points = []
+        chains = {}
 
-            if distances[0] > 0.0 or distances[1] > 0.0:
-                ratio = distances[0] / np.sum(distances)
+        for index, (problem, chain_distances) in enumerate(zip(problems, distances)):
+            origin, destination = problem["origin"], problem["destination"]
 
-            location = origin + direction * ratio * direct_distance
+            if origin is None or destination is None:
+                raise RuntimeError("Invalid chain for GravityChainSolver")
 
-            return dict(
-                valid = False, locations = location.reshape(-1, 2), iterations = None
-            )
+            # Prepare direction and normal direction
+            direct_distance = la.norm(destination - origin)
 
-        elif direct_distance < np.abs(distances[0] - distances[1]):
-            ratio = 1.0
+            if direct_distance < 1e-12: # We have a zero direct distance, choose a direction randomly
+                angle = self.random.random() * np.pi * 2.0
 
-            if distances[0] > 0.0 or distances[1] > 0.0:
-                ratio = distances[0] / np.sum(distances)
+                direction = np.array([
+                    np.cos(angle), np.sin(angle)
+                ]).reshape((1, 2))
 
-            maximum_distance = max(distances)
-            location = origin + direction * ratio * maximum_distance
+            else:
+                direction = (destination - origin) / direct_distance
 
-            return dict(
-                valid = False, locations = location.reshape(-1, 2), iterations = None
-            )
+            # If we have only one variable point, take a short cut
+            if problem["size"] == 1:
+                r = np.nan
 
-        else:
-            A = 0.5 * ( distances[0]**2 - distances[1]**2 + direct_distance**2 ) / direct_distance
-            H = np.sqrt(max(0, distances[0]**2 - A**2))
-            r = self.random.random_sample()
+                if direct_distance != 0.0 and direct_distance <= np.sum(chain_distances) and direct_distance >= np.abs(chain_distances[0] - chain_distances[1]):
+                    r = self.random.random_sample()
 
-            center = origin + direction * A
-            offset = direction * H
-            offset = np.array([offset[0,1], -offset[0,0]])
+                two_points.append((index, origin[0], direction[0], direct_distance, chain_distances[:2], r))
+                continue
 
-            location = center + (1.0 if r < 0.5 else -1.0) * offset
+            normal = np.array([direction[0,1], -direction[0,0]])
 
-            return dict(
-                valid = True, locations = location.reshape(-1, 2), iterations = None
-            )
+            # Prepare initial locations
+            if np.sum(chain_distances) < 1e-12:
+                shares = np.linspace(0, 1, len(chain_distances) - 1)
+            else:
+                shares = np.cumsum(chain_distances[:-1]) / np.sum(chain_distances)
 
-    def solve(self, problem, distances):
-        origin, destination = problem["origin"], problem["destination"]
+            locations = origin + direction * shares[:, np.newaxis] * direct_distance
+            locations = np.vstack([origin, locations, destination])
 
-        if origin is None or destination is None:
-            raise RuntimeError("Invalid chain for GravityChainSolver")
+            if not check_feasibility(chain_distances, direct_distance):
+                results[index] = dict( # We still return some locations although they may not be perfect
+                    valid = False, locations = locations[1:-1], iterations = None
+                )
 
-        # Prepare direction and normal direction
-        direct_distance = la.norm(destination - origin)
+                continue
 
-        if direct_distance < 1e-12: # We have a zero direct distance, choose a direction randomly
-            angle = self.random.random() * np.pi * 2.0
+            # Add lateral devations
+            lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
+            locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(chain_distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
 
-            direction = np.array([
-                np.cos(angle), np.sin(angle)
-            ]).reshape((1, 2))
+            if not problem["size"] in chains:
+                chains[problem["size"]] = []
 
-        else:
-            direction = (destination - origin) / direct_distance
+            chains[problem["size"]].append((index, locations, chain_distances))
 
-        normal = np.array([direction[0,1], -direction[0,0]])
+        if len(two_points) > 0:
+            indices, origins, directions, direct_distances, two_point_distances, r = [np.array(values) for values in zip(*two_points)]
 
-        # If we have only one variable point, take a short cut
-        if problem["size"] == 1:
-             return self.solve_two_points(problem, origin, destination, distances, direction, direct_distance)
+            for index, location, valid in zip(indices, *self.solve_two_points(origins, directions, direct_distances, two_point_distances, r)):
+                results[index] = dict(valid = valid, locations = location.reshape(-1, 2), iterations = None)
 
-        # Prepare initial locations
-        if np.sum(distances) < 1e-12:
-            shares = np.linspace(0, 1, len(distances) - 1)
-        else:
-            shares = np.cumsum(distances[:-1]) / np.sum(distances)
+        for size, items in chains.items():
+            indices, locations, chain_distances = [np.array(values) for values in zip(*items)]
 
-        locations = origin + direction * shares[:, np.newaxis] * direct_distance
-        locations = np.vstack([origin, locations, destination])
+            for index, chain_locations, valid, iterations in zip(indices, *self.solve_chains(locations, chain_distances)):
+                results[index] = dict(valid = valid, locations = chain_locations, iterations = iterations)
 
-        if not check_feasibility(distances, direct_distance):
-            return dict( # We still return some locations although they may not be perfect
-                valid = False, locations = locations[1:-1], iterations = None
-            )
+        return results
 
-        # Add lateral devations
-        lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
-        locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
+    def solve_two_points(self, origins, directions, direct_distances, distances, r):
+        # Closed form for chains with one variable point, the columns of
+        # distances are the distances to the origin and the destination
+        total_distances = np.sum(distances, axis = 1)
 
-        # Prepare gravity simulation
-        valid = False
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            ratios = np.where((distances[:,0] > 0.0) | (distances[:,1] > 0.0), distances[:,0] / total_distances, 1.0)
+
+            A = 0.5 * ( distances[:,0]**2 - distances[:,1]**2 + direct_distances**2 ) / direct_distances
+            H = np.sqrt(np.maximum(0, distances[:,0]**2 - A**2))
+
+        f_zero = direct_distances == 0.0
+        f_far = ~f_zero & (direct_distances > total_distances)
+        f_near = ~f_zero & ~f_far & (direct_distances < np.abs(distances[:,0] - distances[:,1]))
+        f_valid = ~f_zero & ~f_far & ~f_near
+
+        locations = np.zeros((len(origins), 2))
+        valid = np.zeros((len(origins),), dtype = np.bool)
+
+        locations[f_zero] = origins[f_zero] + directions[f_zero] * distances[f_zero, 0][:, np.newaxis]
+        valid[f_zero] = distances[f_zero, 0] == distances[f_zero, 1]
+
+        locations[f_far] = origins[f_far] + directions[f_far] * (ratios[f_far] * direct_distances[f_far])[:, np.newaxis]
+
+        locations[f_near] = origins[f_near] + directions[f_near] * (ratios[f_near] * np.max(distances[f_near], axis = 1))[:, np.newaxis]
+
+        centers = origins[f_valid] + directions[f_valid] * A[f_valid][:, np.newaxis]
+        offsets = directions[f_valid] * H[f_valid][:, np.newaxis]
+        offsets = np.vstack([offsets[:,1], -offsets[:,0]]).T
+
+        locations[f_valid] = centers + np.where(r[f_valid] < 0.5, 1.0, -1.0)[:, np.newaxis] * offsets
+        valid[f_valid] = True
+
+        return locations, valid
 
-        origin_weights = np.ones((len(distances) - 1, 2))
+    def solve_chains(self, locations, distances):
+        # Relaxes chains of the same size together, locations are given as
+        # (chains, points, 2) including origin and destination
+        number_of_chains, number_of_points = locations.shape[0], locations.shape[1] - 2
+
+        result_locations = np.zeros((number_of_chains, number_of_points, 2))
+        result_valid = np.zeros((number_of_chains,), dtype = np.bool)
+        result_iterations = np.zeros((number_of_chains,), dtype = np.int64)
+
+        # Prepare gravity simulation
+        origin_weights = np.ones((number_of_points, 2))
         origin_weights[0,:] = 2.0
 
-        destination_weights = np.ones((len(distances) - 1, 2))
+        destination_weights = np.ones((number_of_points, 2))
         destination_weights[-1,:] = 2.0
 
+        # Chains that have not converged yet
+        active = np.arange(number_of_chains)
+        locations = np.array(locations, dtype = np.float64)
+
         # Run gravity simulation
         for k in range(self.maximum_iterations):
-            directions = locations[:-1] - locations[1:]
-            lengths = la.norm(directions, axis = 1)
+            directions = locations[:,:-1] - locations[:,1:]
+            lengths = la.norm(directions, axis = 2)
 
             offset = distances - lengths
             lengths[lengths < 1.0] = 1.0
-            directions /= lengths[:, np.newaxis]
+            directions /= lengths[:, :, np.newaxis]
 
-            if np.all(np.abs(offset) < self.eps): # Check if we have converged
-                valid = True
-                break
+            converged = np.all(np.abs(offset) < self.eps, axis = 1) # Check if we have converged
+
+            if np.any(converged):
+                result_locations[active[converged]] = locations[converged, 1:-1]
+                result_valid[active[converged]] = True
+                result_iterations[active[converged]] = k
+
+                active, locations, distances = active[~converged], locations[~converged], distances[~converged]
+                directions, offset = directions[~converged], offset[~converged]
+
+                if len(active) == 0:
+                    break
 
             # Apply adjustment to locations
-            adjustment = np.zeros((len(distances) - 1, 2))
-            adjustment -= 0.5 * self.alpha * offset[:-1, np.newaxis] * directions[:-1] * origin_weights
-            adjustment += 0.5 * self.alpha * offset[1:, np.newaxis] * directions[1:] * destination_weights
+            adjustment = np.zeros((len(active), number_of_points, 2))
+            adjustment -= 0.5 * self.alpha * offset[:, :-1, np.newaxis] * directions[:, :-1] * origin_weights
+            adjustment += 0.5 * self.alpha * offset[:, 1:, np.newaxis] * directions[:, 1:] * destination_weights
 
-            locations[1:-1] += adjustment
+            locations[:,1:-1] += adjustment
 
             if np.isnan(locations).any() or np.isinf(locations).any():
                 raise RuntimeError("NaN/Inf value encountered during gravity simulation")
 
-        return dict(
-            valid = valid, locations = locations[1:-1], iterations = k
-        )
+        # Chains that did not converge keep their last locations
+        result_locations[active] = locations[:, 1:-1]
+        result_iterations[active] = self.maximum_iterations - 1
+
+        return result_locations, result_valid, result_iterations
 
 class FeasibleDistanceSampler(DistanceSampler):
-    def __init__(self, random, maximum_iterations = 1000):
+    def __init__(self, random, maximum_iterations = 1000, candidates = 16):
         self.maximum_iterations = maximum_iterations
+        self.candidates = candidates
         self.random = random
 
     def sample_distances(self, problem):
         # Return distance chains per row
         raise NotImplementedError()
 
+    def sample_distances_batch(self, problems, count):
+        # Return count distance chains per problem, each as an array of
+        # shape (count, size + 1)
+        return [np.array([self.sample_distances(problem) for k in range(count)]) for problem in problems]
+
     def sample(self, problem):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -296,6 +415,90 @@ class FeasibleDistanceSampler(DistanceSampler):
             iterations = k
         )
 
+    def sample_batch(self, problems):
+        """
+            Samples distances for many problems at once. Tails get one sample,
+            while chains get a number of candidate samples per round that are
+            checked for feasibility together. Per chain, the first feasible
+            candidate is chosen, or the one with the smallest delta once all
+            iterations are used up.
+        """
+        results = [None] * len(problems)
+
+        single = []
+        chains = {}
+
+        for index, problem in enumerate(problems):
+            origin, destination = problem["origin"], problem["destination"]
+
+            if origin is None and destination is None:
+                raise RuntimeError("Invalid chain for FeasibleDistanceSampler")
+
+            elif origin is None or destination is None: # This is a tail
+                single.append((index, False))
+                continue
+
+            direct_distance = la.norm(destination - origin)
+
+            # One point and two trips
+            if direct_distance < 1e-3 and problem["size"] == 1:
+                single.append((index, True))
+                continue
+
+            length = problem["size"] + 1
+
+            if not length in chains:
+                chains[length] = []
+
+            chains[length].append((index, direct_distance))
+
+        if len(single) > 0:
+            samples = self.sample_distances_batch([problems[index] for index, _ in single], 1)
+
+            for (index, shortcut), distances in zip(single, samples):
+                distances = distances[0]
+
+                if shortcut:
+                    distances = np.array([distances[0], distances[0]])
+
+                results[index] = dict(valid = True, distances = distances, iterations = None)
+
+        for length, items in chains.items():
+            indices = np.array([index for index, _ in items])
+            direct_distances = np.array([direct_distance for _, direct_distance in items])
+
+            best_distances = np.zeros((len(items), length))
+            best_deltas = np.ones((len(items),)) * np.inf
+            iterations = np.ones((len(items),), dtype = np.int64) * (self.maximum_iterations - 1)
+
+            active = np.arange(len(items))
+            draws = 0
+
+            while len(active) > 0 and draws < self.maximum_iterations:
+                count = min(self.candidates, self.maximum_iterations - draws)
+
+                # Distances are given as (chains, candidates, trips)
+                distances = np.array(self.sample_distances_batch([problems[index] for index in indices[active]], count))
+                deltas = calculate_feasibility_batch(distances, direct_distances[active][:, np.newaxis])
+
+                selection = np.argmin(deltas, axis = 1)
+                selected_deltas = deltas[np.arange(len(active)), selection]
+
+                f = selected_deltas < best_deltas[active]
+                best_distances[active[f]] = distances[np.arange(len(active))[f], selection[f]]
+                best_deltas[active[f]] = selected_deltas[f]
+
+                f = selected_deltas == 0.0
+                iterations[active[f]] = draws + selection[f]
+
+                active = active[~f]
+                draws += count
+
+            for index, distances, delta, iteration in zip(indices, best_distances, best_deltas, iterations):
+                results[index] = dict(valid = delta == 0.0, distances = distances, iterations = iteration)
+
+        return results
+
 class DiscretizationErrorObjective(AssignmentObjective):
     def __init__(self, thresholds):
         self.thresholds = thresholds
@@ -1,7 +1,6 @@
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import shapely.geometry as geo
 
 def configure(context):
     context.stage("synthesis.population.spatial.by_person.primary_locations")
@@ -23,29 +22,26 @@ def execute(context):
     df_home_locations = pd.merge(df_home_locations, df_home[["household_id", "x", "y"]].drop_duplicates(), on = "household_id", how = 'left')
     df_home_locations["destination_id"] = -1
     df_home_locations = df_home_locations[["person_id", "activity_id", "destination_id", "x", "y"]]
-    df_home_locations["geometry"] = [geo.Point(px, py) for px, py in list(zip(df_home_locations["x"], df_home_locations["y"]))]
 
     # Work locations
     df_work_locations = df_locations[df_locations["purpose"] == "work"]
     df_work_locations = pd.merge(df_work_locations, df_work[["person_id", "location_id", "x", "y"]], on = "person_id")
     df_work_locations = df_work_locations[["person_id", "activity_id", "location_id", "x", "y"]]
     df_work_locations = df_work_locations.rename(columns={"location_id": "destination_id"})
-    df_work_locations["geometry"] = [geo.Point(px, py) for px, py in list(zip(df_work_locations["x"], df_work_locations["y"]))]
 
     # Education locations
     df_education_locations = df_locations[df_locations["purpose"] == "education"]
     df_education_locations = pd.merge(df_education_locations, df_education[["person_id", "location_id", "x", "y"]], on = "person_id")
     df_education_locations = df_education_locations[["person_id", "activity_id", "location_id", "x", "y"]]
     df_education_locations = df_education_locations.rename(columns={"location_id": "destination_id"})
-    df_education_locations["geometry"] = [geo.Point(px, py) for px, py in list(zip(df_education_locations["x"], df_education_locations["y"]))]
 
     # Secondary locations
     df_secondary_locations = df_locations[~df_locations["purpose"].isin(("home", "work", "education"))].copy()
     df_secondary["activity_id"] = df_secondary["trip_index"] + 1
     df_secondary_locations = pd.merge(df_secondary_locations, df_secondary[[
-        "person_id", "activity_id", "destination_id", "geometry"
+        "person_id", "activity_id", "destination_id", "x", "y"
     ]], on = ["person_id", "activity_id"], how = "left")
-    df_secondary_locations = df_secondary_locations[["person_id", "activity_id", "destination_id", "geometry"]]
+    df_secondary_locations = df_secondary_locations[["person_id", "activity_id", "destination_id", "x", "y"]]
 
     
 
@@ -58,6 +54,8 @@ def execute(context):
 
     assert initial_count == final_count
 
-    df_locations = gpd.GeoDataFrame(df_locations, crs = dict(init = "epsg:29183"))
+    # Geometries are only created once for all locations
+    df_locations = gpd.GeoDataFrame(df_locations, geometry = gpd.points_from_xy(
+        df_locations["x"].values, df_locations["y"].values), crs = dict(init = "epsg:29183"))
 
     return df_locations
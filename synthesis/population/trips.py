@@ -3,10 +3,12 @@ from tqdm import tqdm
 import pandas as pd
 import numpy as np
 #import data.constants as c
+import synthesis.population.algo.random_streams as random_streams
 
 def configure(context):
     context.stage("synthesis.population.sociodemographics")
     context.stage("data.hts.cleaned")
+    context.config("random_seed")
 
 def execute(context):
     df_persons = context.stage("synthesis.population.sociodemographics")[[
@@ -46,7 +48,8 @@ def execute(context):
     interval = df_trips[["person_id", "departure_time"]].groupby("person_id").min().reset_index()["departure_time"].values
     interval = np.minimum(1800.0, interval) # If first departure time is just 5min after midnight, we only add a deviation of 5min
 
-    offset = np.random.random(size = (len(counts), )) * interval * 2.0 - interval
+    random = random_streams.get_generator(context.config("random_seed"), "synthesis.population.trips")
+    offset = random.random(size = (len(counts), )) * interval * 2.0 - interval
     offset = np.repeat(offset, counts)
 
     df_trips["departure_time"] += offset
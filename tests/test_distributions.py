@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from synthesis.population.algo.distributions import ConditionalDistributionTable, EmpiricalDistribution
+
+BOUNDS = [600.0, 1200.0, np.inf]
+
+def test_sampling_stays_in_band():
+    random = np.random.RandomState(0)
+    conditions = random.random_sample(size = 3000) * 1800.0
+
+    table = ConditionalDistributionTable.from_samples(conditions, conditions, np.ones((3000,)), BOUNDS)
+
+    for table in (table, table.resample(0.5), table.resample(-0.5)):
+        samples = table.sample(np.array([300.0, 900.0, 1500.0] * 100), np.random.default_rng(0)).reshape((-1, 3))
+
+        assert np.all(samples[:,0] <= 600.0)
+        assert np.all((samples[:,1] > 600.0) & (samples[:,1] <= 1200.0))
+        assert np.all(samples[:,2] > 1200.0)
+
+def test_empty_band_raises():
+    conditions = np.array([100.0, 200.0, 1300.0, 1400.0])
+
+    with pytest.raises(RuntimeError, match = "Band 1"):
+        ConditionalDistributionTable.from_samples(conditions, conditions, np.ones((4,)), BOUNDS)
+
+def test_band_without_weight_raises():
+    conditions = np.array([100.0, 200.0, 700.0, 800.0, 1300.0])
+    weights = np.array([1.0, 1.0, 0.0, 0.0, 1.0])
+
+    with pytest.raises(RuntimeError, match = "Band 1"):
+        ConditionalDistributionTable.from_samples(conditions, conditions, weights, BOUNDS)
+
+def test_resample_of_band_without_weight_raises():
+    # Tables that are constructed directly are checked when they are resampled
+    table = ConditionalDistributionTable(
+        np.array(BOUNDS), np.array([1.0, 2.0, 3.0]), np.array([1.0, np.nan, 1.0]), np.array([0, 1, 2, 3]))
+
+    with pytest.raises(RuntimeError, match = "Band 1"):
+        table.resample(0.2)
+
+def test_distribution_without_weight_raises():
+    with pytest.raises(RuntimeError):
+        EmpiricalDistribution.from_samples(np.array([1.0, 2.0]), np.array([0.0, 0.0]))
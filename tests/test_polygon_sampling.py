@@ -0,0 +1,34 @@
+import numpy as np
+import shapely.geometry as geo
+
+from synthesis.population.algo.polygon_sampling import PolygonSampler
+
+# A concave zone, for which some triangles of the triangulation are only
+# partially covered by the polygon
+SHAPE = geo.Polygon([
+    (0.18, 0.26), (0.29, 0.44), (0.02, 0.1), (-0.02, 0.13),
+    (-0.36, 0.37), (-0.18, -0.17), (-0.52, -0.49), (0.25, -0.78)
+])
+
+def test_concave_polygon_is_sampled_uniformly():
+    sampler = PolygonSampler()
+    assert np.any(sampler.triangulate(1, SHAPE)["partial"])
+
+    count = 400000
+    points = sampler.sample(1, SHAPE, count, np.random.RandomState(0))
+    assert points.shape == (count, 2)
+
+    # The share of points in every cell of a grid over the zone should match
+    # the share of the zone area in that cell
+    minx, miny, maxx, maxy = SHAPE.bounds
+    xs, ys = np.linspace(minx, maxx, 7), np.linspace(miny, maxy, 7)
+
+    for x0, x1 in zip(xs[:-1], xs[1:]):
+        for y0, y1 in zip(ys[:-1], ys[1:]):
+            expected = geo.box(x0, y0, x1, y1).intersection(SHAPE).area / SHAPE.area
+
+            observed = np.count_nonzero(
+                (points[:,0] >= x0) & (points[:,0] < x1) & (points[:,1] >= y0) & (points[:,1] < y1)
+            ) / count
+
+            assert abs(observed - expected) < 4.0 * np.sqrt(expected * (1.0 - expected) / count) + 1e-4
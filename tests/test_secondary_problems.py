@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from synthesis.population.spatial.by_person.secondary.problems import find_assignment_problems, FIXED_PURPOSES, LOCATION_FIELDS
+
+def find_reference_problems(df, df_locations):
+    # Row by row segmentation as it was done before the columnar table
+    locations = df_locations.set_index("person_id")
+    problems, problem = [], None
+
+    def finish(problem):
+        purposes = problem["purposes"]
+        origin_fixed, destination_fixed = purposes[0] in FIXED_PURPOSES, purposes[-1] in FIXED_PURPOSES
+        assert origin_fixed or destination_fixed
+
+        problem["origin"] = locations.loc[problem["person_id"], ["%s_x" % purposes[0], "%s_y" % purposes[0]]].values if origin_fixed else None
+        problem["destination"] = locations.loc[problem["person_id"], ["%s_x" % purposes[-1], "%s_y" % purposes[-1]]].values if destination_fixed else None
+        problem["purposes"] = purposes[int(origin_fixed):len(purposes) - int(destination_fixed)]
+        problem["size"] = len(problem["purposes"])
+
+        if problem["size"] > 0:
+            problems.append(problem)
+
+    for person_id, trip_id, preceeding_purpose, following_purpose, mode, travel_time in df[[
+        "person_id", "trip_id", "preceeding_purpose", "following_purpose", "mode", "travel_time"]].itertuples(index = False):
+
+        if not problem is None and person_id != problem["person_id"]:
+            finish(problem)
+            problem = None
+
+        if problem is None:
+            problem = dict(person_id = person_id, trip_index = trip_id, purposes = [preceeding_purpose], modes = [], travel_times = [])
+
+        problem["purposes"].append(following_purpose)
+        problem["modes"].append(mode)
+        problem["travel_times"].append(travel_time)
+
+        if following_purpose in FIXED_PURPOSES:
+            finish(problem)
+            problem = None
+
+    if not problem is None:
+        finish(problem)
+
+    return problems
+
+def make_trips(number_of_persons = 500, seed = 0):
+    random = np.random.RandomState(seed)
+    purposes = ["home", "work", "education", "shop", "leisure", "other"]
+
+    trips, locations = [], []
+
+    for person_id in range(number_of_persons):
+        activities = ["home"] + list(random.choice(purposes, size = random.randint(1, 7)))
+
+        for trip_id in range(len(activities) - 1):
+            trips.append((
+                person_id, trip_id, activities[trip_id], activities[trip_id + 1],
+                random.choice(["car", "pt", "walk"]), random.random_sample() * 3600.0
+            ))
+
+        locations.append([person_id] + list(random.random_sample(size = 6) * 1000.0))
+
+    df = pd.DataFrame.from_records(trips, columns = ["person_id", "trip_id", "preceeding_purpose", "following_purpose", "mode", "travel_time"])
+
+    # Purposes and modes are categorical as in data.hts.cleaned
+    for column in ("preceeding_purpose", "following_purpose", "mode"):
+        df[column] = df[column].astype("category")
+
+    return df, pd.DataFrame.from_records(locations, columns = LOCATION_FIELDS)
+
+def test_categorical_trips_match_reference():
+    df, df_locations = make_trips()
+
+    problems = find_assignment_problems(df, df_locations)
+    reference = find_reference_problems(df, df_locations)
+
+    assert len(problems) == len(reference)
+
+    for index, expected in enumerate(reference):
+        problem = problems[index]
+
+        assert problem["person_id"] == expected["person_id"]
+        assert problem["trip_index"] == expected["trip_index"]
+        assert problem["size"] == expected["size"]
+        assert list(problem["purposes"]) == list(expected["purposes"])
+        assert list(problem["modes"]) == list(expected["modes"])
+        assert np.allclose(problem["travel_times"], expected["travel_times"])
+
+        for field in ("origin", "destination"):
+            if expected[field] is None:
+                assert problem[field] is None
+            else:
+                assert np.allclose(problem[field], expected[field].reshape((1, 2)))